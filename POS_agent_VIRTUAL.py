@@ -1,153 +1,16 @@
-import pika
-import json
-import requests
-import sys
-import os
-import time
-from escpos.printer import Usb, Network
-from urllib.parse import urlparse, urlunparse
+"""Virtual agent: every printer is simulated, for development and benchmarks.
 
-# Globals for config and state
-BASE_URL = None
-PASSWORD = None
-PRINTERS = None
+Set "virtual_network_printers": true to drive network printers over real
+sockets, e.g. the TCP sinks benchmark.py starts.
+"""
 
-def get_access_token(base_url, password):
-    url = f"{base_url}/auth/login"
-    payload = {"password": password}
-    try:
-        resp = requests.post(url, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["access_token"]
-    except Exception as e:
-        print(f"Failed to login: {e}")
-        sys.exit(1)
+import multiprocessing
 
-def fetch_printers(base_url, token):
-    url = f"{base_url}/printers/"
-    headers = {"Authorization": f"Bearer {token}"}
-    try:
-        resp = requests.get(url, headers=headers)
-        resp.raise_for_status()
-        printers = resp.json()
-        # Build a dict with printer.name as key, and all printer info as value
-        return {p["name"]: p for p in printers}
-    except Exception as e:
-        print(f"Failed to fetch printers: {e}")
-        sys.exit(1)
+import agent_core
 
-def fetch_rabbitmq_info(base_url, token):
-    url = f"{base_url}/auth/rabbitmq"
-    headers = {"Authorization": f"Bearer {token}"}
-    try:
-        resp = requests.get(url, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["url"], data["queue_name"]  # only what the consumer needs
-    except Exception as e:
-        print(f"Failed to fetch RabbitMQ info: {e}")
-        sys.exit(1)
-
-def load_config(filename="config.json"):
-    exe_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
-    path = os.path.join(exe_dir, filename)
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        print(f"ERROR: '{filename}' not found in {exe_dir}")
-        print("Please make sure config.json is in the same directory as this program.")
-        sys.exit(1)
-    except Exception as e:
-        print(f"Failed to load '{filename}': {e}")
-        sys.exit(1)
-
-def print_receipt(text, printer_cfg, printer_id=None):
-    try:
-        print(f"Printing on printer '{printer_id}' with config: {printer_cfg}")
-        print(f"{text}")
-        return True
-    except Exception as e:
-        print(f"Error printing: {e}")
-        return False
-
-def on_message(ch, method, properties, body):
-    global PRINTERS
-    try:
-        message = json.loads(body)
-        msg_type = message.get("type")
-        action = message.get("action")
-
-        # Reload printer config if printer update/create/delete
-        if msg_type == "printer" and action in ("update", "create", "delete"):
-            print(f"Printer config change detected: {action}. Reloading printers...")
-            token = get_access_token(BASE_URL, PASSWORD)
-            PRINTERS = fetch_printers(BASE_URL, token)
-            print(f"Reloaded printers: {list(PRINTERS.keys())}")
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            return
-
-        printer_id = message.get("printer_id")
-        printer_cfg = PRINTERS.get(printer_id)
-        if printer_cfg:
-            receipt_text = "\n".join(message.get("lines", []))
-            success = print_receipt(receipt_text, printer_cfg, printer_id=printer_id)
-            if success:
-                print(f"Printed for printer_id: {printer_id}")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-            else:
-                print(f"Print failed for printer_id: {printer_id}")
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
-        else:
-            print(f"Unknown printer_id: {printer_id} -- Skipping")
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
-    except Exception as e:
-        print(f"Error processing message: {e}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
-
-def start_rabbitmq_consumer(RABBITMQ_URL, QUEUE_NAME):
-    while True:
-        try:
-            params = pika.URLParameters(RABBITMQ_URL)
-            params.heartbeat = 30
-            connection = pika.BlockingConnection(params)
-            channel = connection.channel()
-            channel.queue_declare(queue=QUEUE_NAME, durable=True)
-            print(f"Listening for print jobs on {QUEUE_NAME}...")
-            channel.basic_consume(queue=QUEUE_NAME, on_message_callback=on_message)
-            channel.start_consuming()
-        except pika.exceptions.AMQPConnectionError as e:
-            print(f"RabbitMQ connection error: {e}. Retrying in 10 seconds...")
-            time.sleep(10)
-        except Exception as e:
-            print(f"Unexpected error: {e}. Retrying in 10 seconds...")
-            time.sleep(10)
-
-def main():
-    global BASE_URL, PASSWORD, PRINTERS
-    config = load_config()
-    BASE_URL = config["base_url"]
-    PASSWORD = config["password"]
-
-    token = get_access_token(BASE_URL, PASSWORD)
-    PRINTERS = fetch_printers(BASE_URL, token)
-    print(f"Available printers by name: {list(PRINTERS.keys())}")
-
-    # Fetch RabbitMQ info dynamically
-    RABBITMQ_URL, QUEUE_NAME = fetch_rabbitmq_info(BASE_URL, token)
-    # Hide password in RabbitMQ URL when printing
-
-    parsed_url = urlparse(RABBITMQ_URL)
-    if parsed_url.password:
-        safe_netloc = parsed_url.netloc.replace(parsed_url.password, "****")
-        safe_url = urlunparse(parsed_url._replace(netloc=safe_netloc))
-    else:
-        safe_url = RABBITMQ_URL
-
-    print(f"Using RabbitMQ URL: {safe_url}, Queue: {QUEUE_NAME}")
-
-    start_rabbitmq_consumer(RABBITMQ_URL, QUEUE_NAME)
+def main(config=None):
+    agent_core.main(config, virtual=True)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Image rasterizing uses a process pool
     main()
@@ -0,0 +1,73 @@
+import collections
+
+
+class AckBatcher:
+    """Settles the deliveries of one channel, acking successes in batches.
+
+    Only use this from the connection thread. With batch_size 1, every ack
+    goes out at once. With a larger batch_size, successful deliveries are
+    acked with multiple=True once every earlier delivery on the channel has
+    been settled. A flush happens when batch_size successes are waiting or
+    after flush_interval seconds. On a timed flush, successes stuck behind a
+    slow job are acked one by one, so a single stuck printer can't use up
+    the prefetch window. Nacks are always sent immediately.
+    """
+
+    def __init__(self, channel, batch_size=1, flush_interval=0.5):
+        self.channel = channel
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self._pending = collections.OrderedDict()  # delivery_tag -> succeeded
+        self._succeeded = 0
+        self._timer = None
+
+    def track(self, delivery_tag):
+        """Register a delivery as soon as it arrives, in delivery order."""
+        if self.batch_size > 1:
+            self._pending[delivery_tag] = False
+
+    def ack(self, delivery_tag):
+        if delivery_tag not in self._pending:
+            if self.channel.is_open:
+                self.channel.basic_ack(delivery_tag=delivery_tag)
+            return
+        self._pending[delivery_tag] = True
+        self._succeeded += 1
+        if self._succeeded >= self.batch_size:
+            self.flush()
+        self._schedule_flush()
+
+    def nack(self, delivery_tag, requeue=True):
+        self._pending.pop(delivery_tag, None)
+        if self.channel.is_open:
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+        self._schedule_flush()
+
+    def flush(self, force=False):
+        """Ack the settled prefix; with force, also ack stragglers individually."""
+        last = None
+        while self._pending:
+            delivery_tag, succeeded = next(iter(self._pending.items()))
+            if not succeeded:
+                break
+            self._pending.popitem(last=False)
+            self._succeeded -= 1
+            last = delivery_tag
+        if not self.channel.is_open:
+            return
+        if last is not None:
+            self.channel.basic_ack(delivery_tag=last, multiple=True)
+        if force and self._succeeded:
+            for delivery_tag, succeeded in list(self._pending.items()):
+                if succeeded:
+                    del self._pending[delivery_tag]
+                    self.channel.basic_ack(delivery_tag=delivery_tag)
+            self._succeeded = 0
+
+    def _schedule_flush(self):
+        if self._succeeded and self._timer is None and self.channel.is_open:
+            self._timer = self.channel.connection.call_later(self.flush_interval, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush(force=True)
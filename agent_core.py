@@ -0,0 +1,699 @@
+"""The print agent shared by the Windows, Linux and virtual entry points.
+
+The platform scripts only pick which printer types they support; everything
+else (API calls, the RabbitMQ consumer, per-printer workers, retries) lives
+here. Heavy dependencies are imported on first use: pika only for the
+blocking engine and printer drivers only when a configured printer needs
+them, see backends.
+"""
+
+import concurrent.futures
+import copy
+import functools
+import json
+import logging
+import sys
+import os
+import threading
+import time
+from urllib.parse import urlparse, urlunparse
+
+import agent_logging
+import backends
+import metrics
+import priority
+import routing
+import snapshot
+import status
+from acks import AckBatcher
+from api_client import ApiClient
+from dedup import DedupIndex, fingerprint, may_be_duplicate
+from dispatcher import DUPLICATE, GONE, MOVED, PrintJob, PrinterDispatcher, printer_queue_size, run_on_connection_thread
+from health import HealthMonitor, PrinterHealth
+from journal import Journal
+from metrics import RENDER_TIME
+from printer_config import BackgroundReloader, diff_printers
+from printer_pool import PrinterConnectionPool
+from render import DEFAULT_ENCODING, compile_message, configure as configure_renderer
+from retry import RetryPolicy
+
+log = logging.getLogger("pos_agent")
+
+# Globals for config and state
+API = None
+PRINTERS = None
+BROKER = None  # (RabbitMQ URL, queue name) from config, the API or the snapshot
+SNAPSHOT_PATH = None
+CONFIG = None
+DISPATCHER = None
+RETRY = None
+RELOADER = None
+JOURNAL = None
+DEDUP = None
+HEALTH = None
+STATUS = None
+PRIORITIES = None
+ROUTING = None
+CHANNEL = None  # The consuming channel, while connected
+CONNECTIONS = PrinterConnectionPool()
+PRINTERS_LOCK = threading.Lock()  # Serializes printer setup and printer map changes
+PRINTERS_PREPARED = threading.Event()  # Set once startup has loaded backends and bound devices
+PRINTERS_READY = threading.Event()  # Set once startup has set up the printers and opened connections
+PRINTER_TYPES = None  # Types this platform supports; None allows all
+VIRTUAL = False
+
+def exe_dir():
+    return os.path.dirname(os.path.abspath(sys.argv[0]))
+
+def data_path(filename):
+    """A path next to the executable, where config.json lives"""
+    return os.path.join(exe_dir(), filename)
+
+def load_config(filename="config.json"):
+    path = data_path(filename)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        log.error("'%s' not found in %s", filename, exe_dir())
+        log.error("Please make sure config.json is in the same directory as this program.")
+        sys.exit(1)
+    except Exception as e:
+        log.error("Failed to load '%s': %s", filename, e)
+        sys.exit(1)
+
+def backend_type(printer_cfg):
+    """The backend that drives a printer on this platform"""
+    printer_type = printer_cfg.get("type")
+    if VIRTUAL:
+        # Only talk to real sockets when asked to, e.g. a benchmark's TCP sink
+        if printer_type == "network" and CONFIG.get("virtual_network_printers"):
+            return printer_type
+        return "virtual"
+    if PRINTER_TYPES is not None and printer_type not in PRINTER_TYPES:
+        raise ValueError(f"Printer type {printer_type} is not supported on this platform")
+    return printer_type
+
+def prepare_printers(printers, skip_types=()):
+    """Run backend setup (e.g. rfcomm binds) before printers get jobs"""
+    types = set()
+    for cfg in printers.values():
+        try:
+            types.add(backend_type(cfg))
+        except ValueError as e:
+            log.warning("%s", e)
+    types.difference_update(skip_types)
+    for printer_type in sorted(types):
+        try:
+            backend = backends.get(printer_type)
+        except Exception as e:
+            log.error("Could not load the %s printer backend: %s", printer_type, e)
+            continue
+        if hasattr(backend, "prepare"):
+            backend.prepare(printers)
+
+def cleanup_printers(printers):
+    """Let loaded backends release what printers no longer use"""
+    for backend in backends.loaded().values():
+        if hasattr(backend, "cleanup"):
+            backend.cleanup(printers)
+
+def open_printer(printer_cfg, printer_id=None):
+    p = backends.get(backend_type(printer_cfg)).open_printer(printer_cfg, printer_id)
+    log.info("Opened connection to printer '%s'", printer_id, extra={"printer_id": printer_id})
+    return p
+
+def print_receipt(data, printer_cfg, printer_id=None):
+    try:
+        backend = backends.get(backend_type(printer_cfg))
+        if hasattr(backend, "open_printer") and STATUS is not None and STATUS.answers(printer_cfg):
+            # The status reply after the ticket confirms the printer took it
+            printer_status = CONNECTIONS.run(printer_id, printer_cfg, open_printer,
+                                             lambda p: STATUS.confirm(printer_id, printer_cfg, p, data))
+            if printer_status is None:
+                CONNECTIONS.invalidate(printer_id)  # Maybe half-open; the next attempt reconnects
+                raise ConnectionError("printer did not confirm the ticket")
+            if printer_status.problem:
+                # It has the ticket and prints it once fixed; sending it again would print it twice
+                log.warning("Printer '%s' took the job but reports %s -- It prints once that is fixed",
+                            printer_id, printer_status.problem, extra={"printer_id": printer_id})
+        elif hasattr(backend, "open_printer"):
+            # One write of the precompiled ESC/POS buffer, cut included
+            CONNECTIONS.run(printer_id, printer_cfg, open_printer, lambda p: p._raw(data))
+        else:
+            backend.write(data, printer_cfg, printer_id)
+    except Exception as e:
+        log.error("Error printing on printer '%s': %s", printer_id, e, extra={"printer_id": printer_id})
+        if HEALTH is not None:
+            HEALTH.failure(printer_id, e)
+        return False
+    if HEALTH is not None:
+        HEALTH.success(printer_id)
+    return True
+
+def probe_printer(printer_id, printer_cfg):
+    """The backend's reachability check; None if it has none or the printer is connected"""
+    if CONNECTIONS.has_connection(printer_id):
+        return None  # Its jobs report on it, and many printers take one connection at a time
+    try:
+        backend = backends.get(backend_type(printer_cfg))
+    except ValueError:
+        return None
+    if not hasattr(backend, "probe"):
+        return None
+    return backend.probe(printer_cfg, timeout=CONFIG.get("health_probe_timeout", 2))
+
+def is_pooled(printer_cfg):
+    """Whether the printer's backend keeps a connection in CONNECTIONS"""
+    try:
+        return hasattr(backends.get(backend_type(printer_cfg)), "open_printer")
+    except ValueError:
+        return False
+
+def printer_problem(printer_id):
+    """Why printer_id can't take a job now, or None"""
+    if HEALTH is not None and not HEALTH.available(printer_id):
+        return "down"
+    if STATUS is not None:
+        return STATUS.problem(printer_id)
+    return None
+
+def target_printer(printer_id, printer_cfg):
+    """(printer_id, config) to print on: the printer, its fallback while it can't print, or None to hold"""
+    problem = printer_problem(printer_id)
+    if problem is None:
+        return printer_id, printer_cfg
+    printers = PRINTERS
+    fallback = CONFIG.get("printer_fallbacks", {}).get(printer_id)
+    if fallback in printers and fallback != printer_id and printer_problem(fallback) is None:
+        log.info("Printer '%s' can't print (%s) -- Moving its jobs to fallback '%s'", printer_id, problem, fallback,
+                 extra={"printer_id": printer_id})
+        return fallback, printers[fallback]
+    return None
+
+def move_job(job, printer_id):
+    """Queue a job on another printer's worker, the only thread that writes to that printer"""
+    moved = copy.copy(job)
+    moved.printer_id = printer_id
+    if DISPATCHER.submit(moved):
+        return MOVED
+    log.warning("Queue for fallback printer '%s' is full", printer_id,
+                extra={"printer_id": job.printer_id, "delivery_tag": job.delivery_tag})
+    return False
+
+def render_job(job, printer_cfg):
+    if VIRTUAL and log.isEnabledFor(logging.DEBUG):
+        log.debug("Receipt for %s:\n%s", job.printer_id, "\n".join(job.message.get("lines", [])),
+                  extra={"printer_id": job.printer_id})
+    with RENDER_TIME.time(printer_id=job.printer_id):
+        return compile_message(job.message, printer_cfg.get("encoding") or DEFAULT_ENCODING)
+
+def remember_printed(job):
+    if DEDUP is not None and job.entry is None:
+        DEDUP.add(fingerprint(job.properties, job.body))  # Before the ack is even scheduled
+
+def wait_for_setup():
+    """Keep a worker from opening a device before startup has bound it (e.g. an rfcomm device)"""
+    if not PRINTERS_PREPARED.is_set():
+        PRINTERS_PREPARED.wait(CONFIG.get("printer_setup_timeout", 30))
+
+def stale_job(job):
+    """GONE or DUPLICATE for a queued job that must not print now, else None"""
+    if job.acker is None:
+        return None  # Journaled; the journal dedups it
+    if not job.acker.channel.is_open:
+        return GONE  # Its ack can't be sent, so the broker redelivers it
+    if (DEDUP is not None and may_be_duplicate(job.properties, job.redelivered)
+            and DEDUP.seen(fingerprint(job.properties, job.body))):
+        return DUPLICATE  # The original printed while this copy waited
+    return None
+
+def handle_print_job(job):
+    """Runs on the printer's worker thread; returns True once printed."""
+    wait_for_setup()
+    stale = stale_job(job)
+    if stale is not None:
+        return stale
+    printer_cfg = PRINTERS.get(job.printer_id)
+    if not printer_cfg:
+        log.warning("Printer %s was removed before its job ran", job.printer_id, extra={"printer_id": job.printer_id})
+        return False
+    target = target_printer(job.printer_id, printer_cfg)
+    if target is None:
+        return False  # Down with no fallback; reject_job holds it without waiting on a connect
+    if target[0] != job.printer_id:
+        return move_job(job, target[0])
+    success = print_receipt(render_job(job, printer_cfg), printer_cfg, printer_id=job.printer_id)
+    if success:
+        remember_printed(job)
+    return success
+
+def handle_print_batch(jobs):
+    """Print several jobs for one printer in as few writes as batch_max_bytes allows.
+
+    Every receipt already ends in a cut, so joining the buffers prints them
+    as separate tickets. Returns one result per job; a failed write fails
+    only the jobs in it.
+    """
+    wait_for_setup()
+    printer_id = jobs[0].printer_id
+    printer_cfg = PRINTERS.get(printer_id)
+    if not printer_cfg:
+        log.warning("Printer %s was removed before its jobs ran", printer_id, extra={"printer_id": printer_id})
+        return [False] * len(jobs)
+    target = target_printer(printer_id, printer_cfg)
+    if target is None:
+        return [False] * len(jobs)
+    if target[0] != printer_id:
+        return [move_job(job, target[0]) for job in jobs]
+    max_bytes = CONFIG.get("batch_max_bytes", 65536)
+    results = [False] * len(jobs)
+    writes, size = [[]], 0
+    for index, job in enumerate(jobs):
+        stale = stale_job(job)
+        if stale is not None:
+            results[index] = stale
+            continue
+        try:
+            data = render_job(job, printer_cfg)
+        except Exception as e:
+            log.error("Could not render job for printer '%s': %s", printer_id, e,
+                      extra={"printer_id": printer_id, "delivery_tag": job.delivery_tag})
+            continue
+        if writes[-1] and size + len(data) > max_bytes:
+            writes.append([])
+            size = 0
+        writes[-1].append((index, data))
+        size += len(data)
+    for write in writes:
+        if not write:
+            continue
+        success = print_receipt(b"".join(data for _, data in write), printer_cfg, printer_id=printer_id)
+        for index, _ in write:
+            results[index] = success
+            if success:
+                remember_printed(jobs[index])
+    return results
+
+def reload_printers():
+    """Fetch the printer list and apply only what changed; runs on RELOADER's thread"""
+    apply_printers(API.fetch_printers())
+
+def apply_printers(new_printers):
+    global PRINTERS
+    with PRINTERS_LOCK:
+        added, changed, removed = diff_printers(PRINTERS, new_printers)
+        if not (added or changed or removed):
+            log.info("Printer config unchanged")
+            return
+        prepare_printers(new_printers)  # e.g. bind new Bluetooth printers before they get jobs
+        # Swap in the new map in one assignment; jobs already running keep their config
+        PRINTERS = new_printers
+        if ROUTING is not None and CHANNEL is not None:
+            run_on_connection_thread(CHANNEL, functools.partial(ROUTING.update, CHANNEL, new_printers))
+        CONNECTIONS.prune(new_printers)
+        cleanup_printers(new_printers)
+        save_snapshot()
+    log.info("Reloaded printers. Added: %s, changed: %s, removed: %s", sorted(added), sorted(changed), sorted(removed))
+
+def fetch_broker_info():
+    if "rabbitmq_url" in CONFIG:
+        return CONFIG["rabbitmq_url"], CONFIG["queue_name"]
+    return API.fetch_rabbitmq_info()
+
+def fetch_from_api():
+    """(printers, broker info), fetched in parallel"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        printers = pool.submit(API.fetch_printers)
+        broker = pool.submit(fetch_broker_info)
+        return printers.result(), broker.result()
+
+def save_snapshot():
+    if SNAPSHOT_PATH:
+        snapshot.save(SNAPSHOT_PATH, PRINTERS, *BROKER)
+
+def refresh_from_api():
+    """Replace the snapshot's printers and broker info with the API's, retrying until it answers"""
+    global BROKER
+    delay = 5
+    while True:
+        try:
+            new_printers, broker = fetch_from_api()
+            break
+        except Exception as e:
+            log.warning("Could not refresh printers from the API: %s. Retrying in %d seconds...", e, delay)
+        time.sleep(delay)
+        delay = min(delay * 2, 300)
+    if broker != BROKER:
+        if broker[1] != BROKER[1]:
+            log.warning("RabbitMQ queue changed from %s to %s. Restart the agent to consume it", BROKER[1], broker[1])
+        else:
+            log.info("RabbitMQ URL changed; using it from the next reconnect")
+        with PRINTERS_LOCK:
+            BROKER = broker
+            save_snapshot()
+    apply_printers(new_printers)
+    log.info("Refreshed printers and RabbitMQ settings from the API")
+
+def warm_connections(printers):
+    """Open pooled printer connections in parallel so the first tickets don't wait for them"""
+    def warm(item):
+        printer_id, printer_cfg = item
+        try:
+            if hasattr(backends.get(backend_type(printer_cfg)), "open_printer"):
+                CONNECTIONS.warm(printer_id, printer_cfg, open_printer)
+        except Exception as e:
+            log.warning("Could not connect to printer '%s' ahead of its first job: %s", printer_id, e,
+                        extra={"printer_id": printer_id})
+            if HEALTH is not None:
+                HEALTH.failure(printer_id, e)
+
+    if printers:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(printers))) as pool:
+            list(pool.map(warm, printers.items()))
+
+def start_printers():
+    """Printer setup that runs while the consumer is already starting"""
+    with PRINTERS_LOCK:
+        printers = PRINTERS
+        try:
+            prepare_printers(printers)  # Load the backends the printers need and bind Bluetooth printers
+        except Exception as e:
+            log.exception("Printer setup failed: %s", e)
+    PRINTERS_PREPARED.set()
+    if JOURNAL is not None:
+        replay_journal()  # Only now can its jobs open their printers
+    if CONFIG.get("prewarm_connections", True):
+        warm_connections(printers)
+    PRINTERS_READY.set()
+
+def complete_job(job):
+    if job.entry is not None:
+        JOURNAL.complete(job.entry)
+    else:
+        job.acker.ack(job.delivery_tag)
+
+def reject_job(job, reason):
+    if HEALTH is not None and HEALTH.is_down(job.printer_id):
+        held = True
+        reason = f"printer {job.printer_id} is down"
+    else:
+        problem = STATUS.problem(job.printer_id) if STATUS is not None else None
+        held = problem is not None
+        if held:
+            reason = f"printer {job.printer_id} reports {problem}"
+    if job.entry is not None and held:
+        log.info("Holding journaled job for %d ms: %s", RETRY.hold_ms, reason, extra={"printer_id": job.printer_id})
+        schedule(RETRY.hold_ms / 1000, submit_journaled, job)
+    elif job.entry is not None:
+        retry_journaled(job, reason)
+    else:
+        RETRY.reject(job.acker, job.delivery_tag, job.properties, job.body, reason, hold=held)
+
+def submit_journaled(job):
+    if not DISPATCHER.submit(job):
+        log.warning("Queue for printer_id %s is full -- Retrying journaled job in 1 second", job.printer_id,
+                    extra={"printer_id": job.printer_id})
+        schedule(1, submit_journaled, job)
+
+def retry_journaled(job, reason):
+    """Journaled jobs are already acked, so they retry locally with the same backoff"""
+    JOURNAL.failed(job.entry, reason)
+    if job.entry.attempts >= RETRY.max_attempts:
+        log.error("Giving up on journaled job after %d attempt(s): %s", job.entry.attempts, reason,
+                  extra={"printer_id": job.printer_id, "attempts": job.entry.attempts})
+        JOURNAL.dead(job.entry, reason)
+        return
+    schedule(RETRY.delay_ms(job.entry.attempts) / 1000, submit_journaled, job)
+
+def schedule(delay, function, *args):
+    timer = threading.Timer(delay, function, args)
+    timer.daemon = True
+    timer.start()
+
+def journal_job(acker, delivery_tag, printer_id, message, properties, body, redelivered=False):
+    """Ack as soon as the job is on disk, then print it from the journal"""
+    def committed(entry, error):
+        if error is not None:
+            run_on_connection_thread(acker.channel, functools.partial(acker.nack, delivery_tag, requeue=True))
+            return
+        run_on_connection_thread(acker.channel, functools.partial(acker.ack, delivery_tag))
+        submit_journaled(PrintJob(None, None, printer_id, message, body=body, entry=entry,
+                                  lane=PRIORITIES.lane(message)))
+
+    fp = fingerprint(properties, body)
+    if not JOURNAL.append(fp, printer_id, body, committed, unique=not may_be_duplicate(properties, redelivered)):
+        log.info("Duplicate of a %s job -- Acking without printing", JOURNAL.state(fp),
+                 extra={"printer_id": printer_id, "delivery_tag": delivery_tag})
+        acker.ack(delivery_tag)
+
+def replay_journal():
+    """Queue jobs that were journaled but not printed before the agent stopped"""
+    entries = JOURNAL.pending()
+    for entry in entries:
+        message = json.loads(entry.body)
+        job = PrintJob(None, None, entry.printer_id, message, body=entry.body, entry=entry,
+                       lane=PRIORITIES.lane(message))
+        if entry.printer_id in PRINTERS:
+            submit_journaled(job)
+        else:
+            retry_journaled(job, f"unknown printer_id: {entry.printer_id}")
+    if entries:
+        log.info("Replaying %d unprinted job(s) from the journal", len(entries))
+
+def on_message(ch, method, properties, body, acker):
+    acker.track(method.delivery_tag)
+    try:
+        message = json.loads(body)
+        if not isinstance(message, dict):
+            raise ValueError("expected a JSON object")
+    except ValueError as e:
+        log.warning("Malformed message: %s -- Dead-lettering", e, extra={"delivery_tag": method.delivery_tag})
+        RETRY.reject(acker, method.delivery_tag, properties, body, f"malformed message: {e}", poison=True)
+        return
+
+    try:
+        msg_type = message.get("type")
+        action = message.get("action")
+
+        # Reload printer config if printer update/create/delete
+        if msg_type == "printer" and action in ("update", "create", "delete"):
+            log.info("Printer config change detected: %s. Reloading printers in background...", action)
+            RELOADER.request()
+            acker.ack(method.delivery_tag)
+            return
+
+        printer_id = message.get("printer_id")
+        if (JOURNAL is None and DEDUP is not None and may_be_duplicate(properties, method.redelivered)
+                and DEDUP.seen(fingerprint(properties, body))):
+            log.info("Duplicate of a printed job -- Acking without printing",
+                     extra={"printer_id": printer_id, "delivery_tag": method.delivery_tag})
+            acker.ack(method.delivery_tag)
+        elif printer_id in PRINTERS and JOURNAL is not None:
+            journal_job(acker, method.delivery_tag, printer_id, message, properties, body, method.redelivered)
+        elif printer_id in PRINTERS:
+            job = PrintJob(acker, method.delivery_tag, printer_id, message, properties, body,
+                           lane=PRIORITIES.lane(message), redelivered=method.redelivered)
+            if not DISPATCHER.submit(job):
+                log.warning(
+                    "Queue for printer_id %s is full -- Retrying later", printer_id,
+                    extra={"printer_id": printer_id, "delivery_tag": method.delivery_tag},
+                )
+                # Backpressure, not a failure: park it without charging an attempt
+                RETRY.reject(acker, method.delivery_tag, properties, body, "printer queue full", busy=True)
+        else:
+            log.warning(
+                "Unknown printer_id: %s -- Retrying later", printer_id,
+                extra={"printer_id": printer_id, "delivery_tag": method.delivery_tag},
+            )
+            RETRY.reject(acker, method.delivery_tag, properties, body, f"unknown printer_id: {printer_id}")
+    except Exception as e:
+        log.exception("Error processing message: %s", e, extra={"delivery_tag": method.delivery_tag})
+        RETRY.reject(acker, method.delivery_tag, properties, body, e)
+
+def safe_url(url):
+    """The URL with its password masked, for logging"""
+    parsed_url = urlparse(url)
+    if not parsed_url.password:
+        return url
+    return urlunparse(parsed_url._replace(netloc=parsed_url.netloc.replace(parsed_url.password, "****")))
+
+def start_rabbitmq_consumer(QUEUE_NAME):
+    global CHANNEL
+    import pika
+
+    RABBITMQ_URL = None
+    delay = 1
+    while True:
+        if RABBITMQ_URL != BROKER[0]:
+            RABBITMQ_URL = BROKER[0]  # refresh_from_api may have replaced the snapshot's
+            log.info("Using RabbitMQ URL: %s, Queue: %s", safe_url(RABBITMQ_URL), QUEUE_NAME)
+        try:
+            params = pika.URLParameters(RABBITMQ_URL)
+            params.heartbeat = CONFIG.get("heartbeat", 30)
+            connection = pika.BlockingConnection(params)
+            channel = connection.channel()
+            if ROUTING is not None:
+                # QUEUE_NAME is this agent's own queue
+                ROUTING.declare(channel, PRINTERS, arguments=priority.queue_arguments(CONFIG))
+            else:
+                channel.queue_declare(queue=QUEUE_NAME, durable=True, arguments=priority.queue_arguments(CONFIG))
+            RETRY.declare(channel)
+            channel.basic_qos(prefetch_count=CONFIG.get("prefetch_count", 50))
+            if CONFIG.get("channel_prefetch_count"):
+                channel.basic_qos(prefetch_count=CONFIG["channel_prefetch_count"], global_qos=True)
+            acker = AckBatcher(
+                channel,
+                batch_size=CONFIG.get("ack_batch_size", 1),
+                flush_interval=CONFIG.get("ack_flush_interval", 0.5),
+            )
+            log.info("Listening for print jobs on %s...", QUEUE_NAME)
+            channel.basic_consume(
+                queue=QUEUE_NAME,
+                on_message_callback=functools.partial(on_message, acker=acker),
+            )
+            delay = 1
+            CHANNEL = channel
+            channel.start_consuming()
+        except pika.exceptions.AMQPConnectionError as e:
+            log.error("RabbitMQ connection error: %s. Retrying in %d seconds...", e, delay)
+        except Exception as e:
+            log.exception("Unexpected error: %s. Retrying in %d seconds...", e, delay)
+        CHANNEL = None
+        # Journaled jobs keep printing meanwhile; back off up to 30 seconds
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+
+def main(config=None, printer_types=None, virtual=False, native_types=("network", "bluetooth-le"), defaults=None):
+    """Run the agent.
+
+    printer_types limits the printer types this platform drives; virtual
+    routes every printer to the virtual backend instead. native_types are
+    the types the asyncio engine drives without a worker thread. defaults
+    are platform defaults for config keys the config file leaves out.
+    """
+    global CONFIG, API, PRINTERS, BROKER, SNAPSHOT_PATH, DISPATCHER, RETRY, RELOADER, JOURNAL, DEDUP, HEALTH, ROUTING
+    global STATUS, PRIORITIES, PRINTER_TYPES, VIRTUAL
+    PRINTER_TYPES = printer_types
+    VIRTUAL = virtual
+    config = CONFIG = dict(defaults or {}, **(config or load_config()))
+    agent_logging.setup(config)
+    backends.configure(config, exe_dir())
+    configure_renderer(
+        cache_bytes=config.get("render_cache_bytes"),
+        image_workers=config.get("render_image_workers"),
+    )
+    journaled = bool(config.get("journal_path"))
+    if journaled and config.get("engine") == "asyncio":
+        log.warning("The asyncio engine doesn't support journal_path; running without a journal, with the dedup index")
+        journaled = False
+    if config.get("dedup_path", "dedup.log") and not journaled:
+        # The journal keeps its own fingerprints
+        DEDUP = DedupIndex(
+            data_path(config.get("dedup_path", "dedup.log")),
+            ttl=config.get("dedup_ttl_hours", 24) * 3600,
+            max_entries=config.get("dedup_max_entries", 100000),
+        )
+    if config.get("snapshot_path", "snapshot.json"):
+        SNAPSHOT_PATH = data_path(config.get("snapshot_path", "snapshot.json"))
+    if config.get("engine") == "asyncio":
+        import async_agent
+        native_types = () if virtual else native_types
+        async_agent.run(
+            config,
+            print_receipt,
+            # The asyncio engine sets up its native printers itself
+            setup_printers=functools.partial(prepare_printers, skip_types=native_types),
+            native_types=native_types,
+            dedup=DEDUP,
+            snapshot_path=SNAPSHOT_PATH,
+        )
+        return
+    API = ApiClient(
+        config["base_url"],
+        config["password"],
+        timeout=config.get("api_timeout", 10),
+        retries=config.get("api_retries", 3),
+    )
+
+    # Start from the last known printers and broker, if any, rather than wait for the API
+    saved = snapshot.load(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
+    if saved is not None:
+        PRINTERS = saved["printers"]
+        if "rabbitmq_url" in config:
+            BROKER = config["rabbitmq_url"], config["queue_name"]
+        else:
+            BROKER = saved["rabbitmq_url"], saved["queue_name"]
+        log.info("Starting from the snapshot saved %s; refreshing from the API in the background",
+                 time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(saved.get("saved_at", 0))))
+    else:
+        try:
+            PRINTERS, BROKER = fetch_from_api()
+        except Exception as e:
+            log.error("Failed to fetch printers and RabbitMQ info: %s", e)
+            sys.exit(1)
+        save_snapshot()
+    QUEUE_NAME = BROKER[1]
+    log.info("Available printers by name: %s", list(PRINTERS.keys()))
+    CONNECTIONS.idle_timeout = config.get("printer_idle_timeout", 300)
+    PRIORITIES = priority.from_config(config)
+    DISPATCHER = PrinterDispatcher(
+        handle_print_job,
+        max_queue_size=printer_queue_size(config),
+        on_failure=reject_job,
+        on_success=complete_job,
+        batch_handler=handle_print_batch,
+        batch_window=config.get("batch_window_ms", 0) / 1000,
+        batch_max_jobs=config.get("batch_max_jobs", 1),
+        priorities=PRIORITIES,
+    )
+    RELOADER = BackgroundReloader(reload_printers)
+    if config.get("metrics_port"):
+        metrics.QUEUE_DEPTH.set_function(DISPATCHER.queue_depths)
+        metrics.serve(config["metrics_port"])
+
+    if config.get("health_enabled", True):
+        HEALTH = PrinterHealth(
+            failure_threshold=config.get("health_failure_threshold", 3),
+            open_seconds=config.get("health_open_seconds", 10),
+        )
+        metrics.PRINTER_UP.set_function(HEALTH.states)
+        HealthMonitor(HEALTH, lambda: PRINTERS, probe_printer, interval=config.get("health_interval", 15)).start()
+
+    if config.get("status_polling", True):
+        STATUS = status.StatusMonitor(
+            CONNECTIONS,
+            lambda: PRINTERS,
+            open_printer,
+            is_pooled,
+            interval=config.get("status_interval", 5),
+            poll_timeout=config.get("status_timeout", 0.5),
+            confirm_timeout=config.get("status_confirm_timeout", 5),
+        )
+        metrics.PRINTER_READY.set_function(STATUS.ready_states)
+        STATUS.start()
+
+    # In routing mode, consume this agent's own queue; retries come back to it too
+    ROUTING = routing.from_config(config, QUEUE_NAME)
+    if ROUTING is not None:
+        QUEUE_NAME = ROUTING.queue_name
+
+    RETRY = RetryPolicy(
+        QUEUE_NAME,
+        max_attempts=config.get("retry_max_attempts", 5),
+        base_delay_ms=config.get("retry_base_delay_ms", 2000),
+        max_delay_ms=config.get("retry_max_delay_ms", 60000),
+        hold_ms=config.get("health_hold_ms", 5000),
+    )
+
+    if config.get("journal_path"):
+        JOURNAL = Journal(
+            data_path(config["journal_path"]),
+            commit_interval=config.get("journal_commit_ms", 10) / 1000,
+            keep_done=config.get("journal_keep_done_hours", 168) * 3600,
+        )  # start_printers replays it once the printers are set up
+
+    threading.Thread(target=start_printers, name="printer-setup", daemon=True).start()
+    if saved is not None:
+        threading.Thread(target=refresh_from_api, name="api-refresh", daemon=True).start()
+    start_rabbitmq_consumer(QUEUE_NAME)
@@ -0,0 +1,149 @@
+"""Non-blocking, structured logging for the agents.
+
+Log calls on the print path only put the record on an in-memory queue. A
+listener thread formats it and does the console and file I/O. A slow SD card
+or serial console then shows up as listener lag, never as ticket latency.
+
+Structured fields travel in `extra`, e.g.
+
+    log.info("Printed", extra={"printer_id": "bar", "delivery_tag": 7, "duration_ms": 41.2})
+
+and come out as JSON keys. The last log_events records stay in EVENTS, a ring
+buffer that can be queried for diagnostics (GET /events on the metrics port)
+without touching disk.
+
+config.json keys: log_level, log_format ("text" or "json") for the console,
+log_console, log_file (rotated JSON lines), log_max_bytes, log_backup_count
+and log_events.
+"""
+
+import atexit
+import collections
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_STANDARD_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "taskName"}
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+
+
+def record_fields(record):
+    """A log record as a flat dict: time, level, logger, message and extras."""
+    fields = {
+        "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+        "level": record.levelname,
+        "logger": record.name,
+        "message": record.getMessage(),
+    }
+    for key, value in record.__dict__.items():
+        if key not in _STANDARD_ATTRS and not key.startswith("_"):
+            fields[key] = value
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        fields = record_fields(record)
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=str, ensure_ascii=False)
+
+
+class RecentEvents(logging.Handler):
+    """Keeps the last `capacity` records as dicts in memory."""
+
+    def __init__(self, capacity=1000):
+        super().__init__()
+        self._events = collections.deque(maxlen=capacity)
+        self._events_lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return self._events.maxlen
+
+    def resize(self, capacity):
+        with self._events_lock:
+            self._events = collections.deque(self._events, maxlen=capacity)
+
+    def emit(self, record):
+        fields = record_fields(record)
+        with self._events_lock:
+            self._events.append(fields)
+
+    def query(self, level=None, printer_id=None, contains=None, limit=100):
+        """Most recent events first, optionally filtered."""
+        min_level = logging.getLevelName(level.upper()) if level else 0
+        if not isinstance(min_level, int):
+            raise ValueError(f"Unknown log level: {level}")
+        with self._events_lock:
+            events = list(self._events)
+        matched = []
+        for event in reversed(events):
+            if logging.getLevelName(event["level"]) < min_level:
+                continue
+            if printer_id is not None and event.get("printer_id") != printer_id:
+                continue
+            if contains and contains not in event["message"]:
+                continue
+            matched.append(event)
+            if len(matched) >= limit:
+                break
+        return matched
+
+
+EVENTS = RecentEvents()
+
+
+def setup(config):
+    """Route all logging through a queue and the listener thread; call once in main()."""
+    global _listener
+    level = str(config.get("log_level", "INFO")).upper()
+    EVENTS.resize(config.get("log_events", 1000))
+
+    handlers = [EVENTS]
+    if config.get("log_console", True):
+        console = logging.StreamHandler(sys.stdout)
+        if config.get("log_format") == "json":
+            console.setFormatter(JsonFormatter())
+        else:
+            console.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handlers.append(console)
+    if config.get("log_file"):
+        file_handler = logging.handlers.RotatingFileHandler(
+            config["log_file"],
+            maxBytes=config.get("log_max_bytes", 5 * 1024 * 1024),
+            backupCount=config.get("log_backup_count", 3),
+            encoding="utf-8",
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    if _listener is not None:
+        _listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown():
+    """Flush queued records; registered with atexit."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
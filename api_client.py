@@ -0,0 +1,110 @@
+import base64
+import json
+import threading
+import time
+
+
+class ApiError(Exception):
+    """The backend could not be reached or returned an unusable response."""
+
+
+def token_expiry(token, data, default_ttl):
+    """Best guess at when a bearer token expires, as a time.time() value."""
+    if data.get("expires_in"):
+        return time.time() + float(data["expires_in"])
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + default_ttl
+
+
+class ApiClient:
+    """Client for the POS backend API.
+
+    All calls share one pooled requests.Session, so they reuse the same
+    keep-alive TLS connection. Calls have a timeout and retry with backoff
+    on connection errors and 429/5xx responses. The bearer token is cached
+    and refreshed shortly before it expires, or once after a 401.
+
+    requests is imported with the first call: an agent that starts from its
+    snapshot doesn't need it until the background refresh.
+    """
+
+    def __init__(self, base_url, password, timeout=10, retries=3, backoff=0.5,
+                 token_ttl=3600, refresh_margin=60):
+        self.base_url = base_url.rstrip("/")
+        self.password = password
+        self.timeout = timeout
+        self.token_ttl = token_ttl
+        self.refresh_margin = refresh_margin
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                session = requests.Session()
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=self.backoff,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=None,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(max_retries=retry, pool_maxsize=4)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def get_access_token(self, force_refresh=False):
+        with self._lock:
+            if force_refresh or self._token is None or time.time() >= self._expires_at - self.refresh_margin:
+                data = self._request("POST", "/auth/login", auth=False, json={"password": self.password})
+                try:
+                    self._token = data["access_token"]
+                except (KeyError, TypeError):
+                    raise ApiError("Login response has no access_token")
+                self._expires_at = token_expiry(self._token, data, self.token_ttl)
+            return self._token
+
+    def fetch_printers(self):
+        printers = self._request("GET", "/printers/")
+        # Build a dict with printer.name as key, and all printer info as value
+        return {p["name"]: p for p in printers}
+
+    def fetch_rabbitmq_info(self):
+        data = self._request("GET", "/auth/rabbitmq")
+        return data["url"], data["queue_name"]  # only what the consumer needs
+
+    def _request(self, method, path, auth=True, **kwargs):
+        import requests
+
+        url = f"{self.base_url}{path}"
+        for attempt in range(2):
+            headers = {}
+            if auth:
+                headers["Authorization"] = f"Bearer {self.get_access_token(force_refresh=attempt > 0)}"
+            try:
+                resp = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                raise ApiError(f"{method} {path} failed: {e}") from e
+            if resp.status_code == 401 and auth and attempt == 0:
+                continue  # Token revoked or expired early; log in again once
+            try:
+                resp.raise_for_status()
+                return resp.json()
+            except (requests.HTTPError, ValueError) as e:
+                raise ApiError(f"{method} {path} failed: {e}") from e
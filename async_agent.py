@@ -0,0 +1,353 @@
+"""asyncio run mode: AMQP, backend API calls and printers in one event loop.
+
+Enabled with "engine": "asyncio" in config.json. Network printers are driven
+directly with asyncio.open_connection and Bluetooth LE printers with bleak
+(the open_async side of backends.network and backends.ble), so one process can keep dozens of printers busy with a single thread.
+Printer types without an async driver (USB, rfcomm serial, Windows spooler)
+fall back to the agent's blocking print_receipt on a worker thread.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+import backends
+import metrics
+import priority
+import routing
+import snapshot
+
+from api_client import ApiClient
+from dedup import fingerprint, may_be_duplicate
+from dispatcher import printer_queue_size
+from metrics import JOBS, RENDER_TIME, TIME_IN_QUEUE, WRITE_TIME
+from printer_config import diff_printers
+from render import DEFAULT_ENCODING, compile_message
+from retry import RetryPolicy
+
+log = logging.getLogger(__name__)
+
+
+class AsyncAgent:
+    def __init__(self, config, print_blocking, setup_printers=None, native_types=("network", "bluetooth-le"),
+                 dedup=None, snapshot_path=None):
+        self.config = config
+        self.print_blocking = print_blocking
+        self.setup_printers = setup_printers
+        self.native_types = native_types
+        self.dedup = dedup
+        self.snapshot_path = snapshot_path
+        self.api = ApiClient(
+            config["base_url"],
+            config["password"],
+            timeout=config.get("api_timeout", 10),
+            retries=config.get("api_retries", 3),
+        )
+        self.printers = {}
+        self.broker = None
+        self.devices = {}
+        self.queues = {}
+        self.retry = None
+        self.routing = None
+        self.channel = None
+        self.queue = None
+        self.exchange = None
+        self.priorities = priority.from_config(config)
+        self._sequence = itertools.count()
+        self.queue_size = printer_queue_size(config)
+        self._reload_lock = asyncio.Lock()
+        self._refresh = None
+
+    async def run(self):
+        import aio_pika
+
+        saved = snapshot.load(self.snapshot_path) if self.snapshot_path else None
+        if saved is not None:
+            self.printers = saved["printers"]
+            if "rabbitmq_url" in self.config:
+                self.broker = self.config["rabbitmq_url"], self.config["queue_name"]
+            else:
+                self.broker = saved["rabbitmq_url"], saved["queue_name"]
+            log.info("Starting from the snapshot; refreshing from the API in the background")
+            self._refresh = asyncio.create_task(self.refresh_from_api())
+        else:
+            self.printers, self.broker = await self.fetch_from_api()
+            self.save_snapshot()
+        rabbitmq_url, queue_name = self.broker
+        log.info("Available printers by name: %s", list(self.printers.keys()))
+        if self.config.get("metrics_port"):
+            metrics.QUEUE_DEPTH.set_function(lambda: {p: q.qsize() for p, q in self.queues.items()})
+            metrics.serve(self.config["metrics_port"])
+        if self.setup_printers:
+            await asyncio.to_thread(self.setup_printers, self.printers)
+        self._connect_native_printers()
+
+        self.routing = routing.from_config(self.config, queue_name)
+        if self.routing is not None:
+            queue_name = self.routing.queue_name
+        self.retry = RetryPolicy(
+            queue_name,
+            max_attempts=self.config.get("retry_max_attempts", 5),
+            base_delay_ms=self.config.get("retry_base_delay_ms", 2000),
+            max_delay_ms=self.config.get("retry_max_delay_ms", 60000),
+            hold_ms=self.config.get("health_hold_ms", 5000),
+        )
+        connection = await aio_pika.connect_robust(rabbitmq_url, heartbeat=self.config.get("heartbeat", 30))
+        async with connection:
+            self.channel = await connection.channel()
+            await self.channel.set_qos(prefetch_count=self.config.get("prefetch_count", 50))
+            self.queue = await self.channel.declare_queue(
+                queue_name, durable=True, arguments=priority.queue_arguments(self.config)
+            )
+            if self.routing is not None:
+                self.exchange = await self.channel.declare_exchange(
+                    self.routing.exchange, aio_pika.ExchangeType(self.routing.exchange_type), durable=True
+                )
+                await self.update_routing()
+            for name, arguments in self.retry.queues():
+                await self.channel.declare_queue(name, durable=True, arguments=arguments)
+            await self.queue.consume(self.on_message)
+            log.info("Listening for print jobs on %s (asyncio)...", queue_name)
+            await asyncio.Future()
+
+    async def on_message(self, message):
+        try:
+            payload = json.loads(message.body)
+            if not isinstance(payload, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            log.warning("Malformed message: %s -- Dead-lettering", e)
+            await self.reject(message, f"malformed message: {e}", poison=True)
+            return
+
+        if payload.get("type") == "printer" and payload.get("action") in ("update", "create", "delete"):
+            log.info("Printer config change detected: %s. Reloading printers in background...", payload["action"])
+            asyncio.create_task(self.reload_printers())
+            await message.ack()
+            return
+
+        printer_id = payload.get("printer_id")
+        if (self.dedup is not None and may_be_duplicate(message, message.redelivered)
+                and self.dedup.seen(fingerprint(message, message.body))):
+            log.info("Duplicate of a printed job -- Acking without printing", extra={"printer_id": printer_id})
+            await message.ack()
+            return
+        if printer_id not in self.printers:
+            log.warning("Unknown printer_id: %s -- Retrying later", printer_id, extra={"printer_id": printer_id})
+            await self.reject(message, f"unknown printer_id: {printer_id}")
+            return
+        enqueued_at = time.monotonic()
+        deadline = self.priorities.deadline(self.priorities.lane(payload), enqueued_at)
+        try:
+            self._queue_for(printer_id).put_nowait((deadline, next(self._sequence), message, payload, enqueued_at))
+        except asyncio.QueueFull:
+            log.warning(
+                "Queue for printer_id %s is full -- Retrying later", printer_id, extra={"printer_id": printer_id}
+            )
+            await self.reject(message, "printer queue full", busy=True)
+
+    async def reject(self, message, reason, poison=False, hold=False, busy=False):
+        import aio_pika
+
+        queue_name, headers = self.retry.route(message.headers, reason, poison, hold, busy)
+        copy = aio_pika.Message(
+            message.body,
+            headers=headers,
+            content_type=message.content_type,
+            message_id=message.message_id,
+            priority=message.priority,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        )
+        try:
+            await self.channel.default_exchange.publish(copy, routing_key=queue_name)
+        except Exception as e:
+            log.error("Failed to publish to %s: %s. Requeueing instead", queue_name, e)
+            await message.nack(requeue=True)
+            return
+        await message.ack()
+
+    async def fetch_broker_info(self):
+        if "rabbitmq_url" in self.config:
+            return self.config["rabbitmq_url"], self.config["queue_name"]
+        return await asyncio.to_thread(self.api.fetch_rabbitmq_info)
+
+    async def fetch_from_api(self):
+        printers, broker = await asyncio.gather(asyncio.to_thread(self.api.fetch_printers), self.fetch_broker_info())
+        return printers, broker
+
+    def save_snapshot(self):
+        if self.snapshot_path:
+            snapshot.save(self.snapshot_path, self.printers, *self.broker)
+
+    async def refresh_from_api(self):
+        """Replace the snapshot's printers and broker info with the API's, retrying until it answers"""
+        delay = 5
+        while True:
+            try:
+                new_printers, broker = await self.fetch_from_api()
+                break
+            except Exception as e:
+                log.warning("Could not refresh printers from the API: %s. Retrying in %d seconds...", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+        if broker != self.broker:
+            # connect_robust keeps reconnecting to the URL it was given
+            log.warning("RabbitMQ settings changed. Restart the agent to use them")
+            self.broker = broker
+            self.save_snapshot()
+        await self.apply_printers(new_printers)
+
+    async def reload_printers(self):
+        try:
+            new_printers = await asyncio.to_thread(self.api.fetch_printers)
+        except Exception as e:
+            log.exception("Printer reload failed, keeping current printers: %s", e)
+            return
+        await self.apply_printers(new_printers)
+
+    async def apply_printers(self, new_printers):
+        async with self._reload_lock:
+            added, changed, removed = diff_printers(self.printers, new_printers)
+            if not (added or changed or removed):
+                log.info("Printer config unchanged")
+                return
+            if self.setup_printers:
+                await asyncio.to_thread(self.setup_printers, new_printers)
+            self.printers = new_printers
+            for printer_id in changed | removed:
+                device = self.devices.pop(printer_id, None)
+                if device is not None:
+                    await device.close()
+            self._connect_native_printers()
+            if self.routing is not None and self.exchange is not None:
+                await self.update_routing()
+            self.save_snapshot()
+            log.info(
+                "Reloaded printers. Added: %s, changed: %s, removed: %s", sorted(added), sorted(changed), sorted(removed)
+            )
+
+    async def update_routing(self):
+        """Bind new printers' routing keys and unbind removed ones."""
+        bind, unbind = self.routing.changes(self.printers)
+        for key in sorted(bind):
+            await self.queue.bind(self.exchange, routing_key=key)
+            self.routing.bound.add(key)
+        for key in sorted(unbind):
+            await self.queue.unbind(self.exchange, routing_key=key)
+            self.routing.bound.discard(key)
+        if bind or unbind:
+            log.info("Routing %s: bound %s, unbound %s", self.routing.queue_name, sorted(bind), sorted(unbind))
+
+    def _queue_for(self, printer_id):
+        q = self.queues.get(printer_id)
+        if q is None:
+            q = self.queues[printer_id] = asyncio.PriorityQueue(maxsize=self.queue_size)
+            asyncio.create_task(self._worker(printer_id, q))
+        return q
+
+    async def _worker(self, printer_id, q):
+        while True:
+            _, _, message, payload, enqueued_at = await q.get()
+            started = time.monotonic()
+            TIME_IN_QUEUE.observe(started - enqueued_at, printer_id=printer_id)
+            if await self._skip_stale(printer_id, message):
+                continue
+            reason = "print failed"
+            try:
+                success = await self.print_job(printer_id, payload)
+            except Exception as e:
+                log.error("Error printing on printer '%s': %s", printer_id, e, extra={"printer_id": printer_id})
+                success = False
+                reason = str(e)
+            JOBS.inc(printer_id=printer_id, result="success" if success else "failure")
+            if success and self.dedup is not None:
+                self.dedup.add(fingerprint(message, message.body))
+            log.info(
+                "Printed" if success else "Print failed",
+                extra={
+                    "printer_id": printer_id,
+                    "delivery_tag": message.delivery_tag,
+                    "queued_ms": round((started - enqueued_at) * 1000, 1),
+                    "duration_ms": round((time.monotonic() - started) * 1000, 1),
+                },
+            )
+            try:
+                if success:
+                    await message.ack()
+                else:
+                    await self.reject(message, reason)
+            except Exception as e:
+                log.error("Could not settle message for printer '%s': %s", printer_id, e, extra={"printer_id": printer_id})
+
+    async def _skip_stale(self, printer_id, message):
+        """Settle a queued message that must not print now; returns True if it was one."""
+        from aio_pika.exceptions import ChannelInvalidStateError
+
+        try:
+            message.channel  # Raises once the delivery's channel is closed
+        except ChannelInvalidStateError:
+            # Its ack can't be sent, so the broker redelivers it
+            JOBS.inc(printer_id=printer_id, result="gone")
+            log.info("Delivery gone -- Not printed", extra={"printer_id": printer_id})
+            return True
+        if (self.dedup is not None and may_be_duplicate(message, message.redelivered)
+                and self.dedup.seen(fingerprint(message, message.body))):
+            # The original printed while this copy waited
+            JOBS.inc(printer_id=printer_id, result="duplicate")
+            log.info("Duplicate of a printed job -- Acking without printing", extra={"printer_id": printer_id})
+            try:
+                await message.ack()
+            except Exception as e:
+                log.error("Could not settle message for printer '%s': %s", printer_id, e,
+                          extra={"printer_id": printer_id})
+            return True
+        return False
+
+    async def print_job(self, printer_id, payload):
+        printer_cfg = self.printers.get(printer_id)
+        if not printer_cfg:
+            log.warning("Printer %s was removed before its job ran", printer_id, extra={"printer_id": printer_id})
+            return False
+        encoding = printer_cfg.get("encoding") or DEFAULT_ENCODING
+        with RENDER_TIME.time(printer_id=printer_id):
+            if payload.get("segments"):
+                # Images and URL fetches may block; keep them off the event loop
+                data = await asyncio.to_thread(compile_message, payload, encoding)
+            else:
+                data = compile_message(payload, encoding)
+        if printer_cfg.get("type") not in self.native_types:
+            return await asyncio.to_thread(self.print_blocking, data, printer_cfg, printer_id)
+        device = self.devices.get(printer_id)
+        if device is None:
+            device = self.devices[printer_id] = self._open_device(printer_cfg)
+        with WRITE_TIME.time(printer_id=printer_id):  # Includes reconnecting, if needed
+            await device.write(data)
+        return True
+
+    def _connect_native_printers(self):
+        """Open connections ahead of the first job where the driver supports it (BLE)."""
+        for printer_id, printer_cfg in self.printers.items():
+            if printer_id in self.devices or printer_cfg.get("type") not in self.native_types:
+                continue
+            try:
+                device = self.devices[printer_id] = self._open_device(printer_cfg)
+            except Exception as e:
+                log.warning("Cannot open printer %s: %s", printer_id, e, extra={"printer_id": printer_id})
+                continue
+            if hasattr(device, "connect_in_background"):
+                device.connect_in_background()
+
+    def _open_device(self, printer_cfg):
+        return backends.get(printer_cfg.get("type")).open_async(printer_cfg)
+
+
+def run(config, print_blocking, setup_printers=None, native_types=("network", "bluetooth-le"), dedup=None,
+        snapshot_path=None):
+    agent = AsyncAgent(config, print_blocking, setup_printers=setup_printers, native_types=native_types, dedup=dedup,
+                       snapshot_path=snapshot_path)
+    try:
+        asyncio.run(agent.run())
+    except KeyboardInterrupt:
+        pass
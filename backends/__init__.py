@@ -0,0 +1,95 @@
+"""Printer backends, keyed by the printer "type" the backend API returns.
+
+A backend module is imported the first time a configured printer needs it,
+so an agent with only network printers never loads pyusb, pyserial, bleak
+or win32print. Each loader is a plain import statement rather than an
+importlib call so PyInstaller still finds and bundles every backend.
+
+A backend module provides either
+
+    open_printer(printer_cfg, printer_id) -> escpos-style printer with
+        _raw(data) and close(), kept open by the connection pool, or
+    write(data, printer_cfg, printer_id) for one-shot writes,
+
+and optionally open_async(printer_cfg) for the asyncio engine, plus
+prepare(printers) / cleanup(printers) hooks that run when the printer map
+is loaded or changes. probe(printer_cfg, timeout) is the health monitor's
+cheap reachability check: truthy if the printer answers, False or an
+exception if it doesn't, None if the backend can't tell. configure(config, data_dir) runs when the backend is
+loaded, with the agent's config and the directory for its state files.
+"""
+
+import threading
+
+
+def _load_usb():
+    from backends import usb
+    return usb
+
+
+def _load_network():
+    from backends import network
+    return network
+
+
+def _load_bluetooth():
+    from backends import bluetooth
+    return bluetooth
+
+
+def _load_windows():
+    from backends import windows
+    return windows
+
+
+def _load_ble():
+    from backends import ble
+    return ble
+
+
+def _load_virtual():
+    from backends import virtual
+    return virtual
+
+
+LOADERS = {
+    "usb": _load_usb,
+    "network": _load_network,
+    "bluetooth": _load_bluetooth,
+    "windows": _load_windows,
+    "bluetooth-le": _load_ble,
+    "virtual": _load_virtual,
+}
+
+_loaded = {}
+_lock = threading.Lock()
+_settings = ({}, ".")
+
+
+def configure(config, data_dir):
+    """Settings handed to each backend's configure() when it loads."""
+    global _settings
+    _settings = (config, data_dir)
+
+
+def get(printer_type):
+    """The backend module for a printer type, importing it on first use."""
+    backend = _loaded.get(printer_type)
+    if backend is not None:
+        return backend
+    loader = LOADERS.get(printer_type)
+    if loader is None:
+        raise ValueError(f"Unknown printer type: {printer_type}")
+    with _lock:
+        backend = _loaded.get(printer_type)
+        if backend is None:
+            backend = loader()
+            if hasattr(backend, "configure"):
+                backend.configure(*_settings)
+            _loaded[printer_type] = backend
+    return backend
+
+
+def loaded():
+    with _lock:
+        return dict(_loaded)
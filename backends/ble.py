@@ -0,0 +1,262 @@
+"""Bluetooth LE printers, driven with bleak.
+
+connection_data takes the printer's "mac_address" (or a "name" to discover
+it by) and optionally "write_characteristic" (a UUID), "chunk_size",
+"window" and "pacing_ms".
+
+The GATT connection stays open between jobs and is re-established in the
+background when the printer drops it. Scan results and each printer's
+write characteristic are cached, so only the first job pays for discovery.
+Receipts go out as MTU-sized write-without-response chunks. After every
+`window` chunks one chunk is written with response, or the writer sleeps
+pacing_ms if the characteristic has no acknowledged writes. That keeps
+the printer's small receive buffer from overflowing without paying a
+round trip per chunk.
+
+The asyncio engine awaits AsyncBlePrinter directly. The blocking engine
+runs the same code on one background event loop shared by all BLE
+printers.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 20
+WRITE_TIMEOUT = 60
+DEFAULT_WINDOW = 16
+DEFAULT_PACING_MS = 20
+MAX_RECONNECT_DELAY = 30
+
+_loop = None
+_loop_lock = threading.Lock()
+_devices = {}  # printer_id -> AsyncBlePrinter
+_discovered = {}  # mac address or name -> BLEDevice
+_write_chars = {}  # mac address -> write characteristic UUID
+
+
+class AsyncBlePrinter:
+    """A Bluetooth LE printer that keeps its GATT connection between jobs."""
+
+    def __init__(self, address=None, name=None, write_characteristic=None, chunk_size=None,
+                 window=DEFAULT_WINDOW, pacing_ms=DEFAULT_PACING_MS):
+        if not (address or name):
+            raise ValueError("A Bluetooth LE printer needs a mac_address or a name")
+        self.address = address
+        self.name = name
+        self.write_characteristic = write_characteristic
+        self.chunk_size = chunk_size
+        self.window = max(1, int(window))
+        self.pacing = pacing_ms / 1000
+        self._client = None
+        self._char = None
+        self._closing = False
+        self._connect_lock = None
+        self._write_lock = None  # One job at a time on the characteristic
+        self._reconnect_task = None
+
+    @property
+    def key(self):
+        return self.address or self.name
+
+    @property
+    def is_connected(self):
+        return self._client is not None and self._client.is_connected
+
+    async def write(self, data):
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            reused = self.is_connected
+            await self._ensure_connected()
+            try:
+                await self._write_chunks(data)
+            except asyncio.CancelledError:
+                await self._disconnect()  # Timed out mid-ticket; start the next job on a fresh link
+                raise
+            except Exception as e:
+                await self._disconnect()
+                if not reused:
+                    raise
+                log.warning("BLE printer %s failed mid-write (%s). Reconnecting...", self.key, e)
+                await self._ensure_connected()
+                await self._write_chunks(data)
+
+    def connect_in_background(self):
+        """Start connecting from the printer's event loop; writes wait for it."""
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def close(self):
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        await self._disconnect()
+
+    async def _ensure_connected(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if not self.is_connected:
+                await self._connect()
+
+    async def _connect(self):
+        from bleak import BleakClient
+
+        device = await self._find_device()
+        client = BleakClient(device, disconnected_callback=self._on_disconnect, timeout=CONNECT_TIMEOUT)
+        await client.connect()
+        self._client = client
+        self._char = self._resolve_write_char(client)
+        log.info("Connected to BLE printer %s", self.key)
+
+    async def _find_device(self):
+        """A BLEDevice from an earlier scan, or a fresh one; saves a scan per connect."""
+        from bleak import BleakScanner
+
+        device = _discovered.get(self.key)
+        if device is not None:
+            return device
+        if self.address:
+            device = await BleakScanner.find_device_by_address(self.address, timeout=CONNECT_TIMEOUT)
+        else:
+            device = await BleakScanner.find_device_by_name(self.name, timeout=CONNECT_TIMEOUT)
+        if device is None:
+            raise ConnectionError(f"BLE printer {self.key} not found")
+        _discovered[self.key] = _discovered[device.address] = device
+        if not self.address:
+            self.address = device.address
+        return device
+
+    def _resolve_write_char(self, client):
+        uuid = self.write_characteristic or _write_chars.get(self.address)
+        if uuid:
+            char = client.services.get_characteristic(uuid)
+            if char is not None:
+                return char
+        fallback = None
+        for service in client.services:
+            for char in service.characteristics:
+                if "write-without-response" in char.properties:
+                    _write_chars[self.address] = char.uuid
+                    return char
+                if fallback is None and "write" in char.properties:
+                    fallback = char
+        if fallback is None:
+            raise RuntimeError(f"No writable characteristic found on {self.key}")
+        _write_chars[self.address] = fallback.uuid
+        return fallback
+
+    async def _write_chunks(self, data):
+        client, char = self._client, self._char
+        without_response = "write-without-response" in char.properties
+        with_response = "write" in char.properties
+        size = self.chunk_size or (char.max_write_without_response_size if without_response else client.mtu_size - 3)
+        size = max(20, size)
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        for index, chunk in enumerate(chunks, 1):
+            if not without_response:
+                await client.write_gatt_char(char, chunk, response=True)
+                continue
+            # Every window, and for the last chunk, wait for the printer to take it
+            barrier = index % self.window == 0 or index == len(chunks)
+            await client.write_gatt_char(char, chunk, response=barrier and with_response)
+            if barrier and not with_response:
+                await asyncio.sleep(self.pacing)
+
+    async def _disconnect(self):
+        client, self._client = self._client, None
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                log.debug("Error disconnecting BLE printer %s: %s", self.key, e)
+
+    def _on_disconnect(self, client):
+        if self._closing or client is not self._client:
+            return
+        log.warning("BLE printer %s disconnected. Reconnecting in the background...", self.key)
+        self.connect_in_background()
+
+    async def _reconnect(self):
+        delay = 1
+        while not self._closing and not self.is_connected:
+            try:
+                await self._ensure_connected()
+                return
+            except Exception as e:
+                _discovered.pop(self.key, None)  # The printer may have moved or changed its address type
+                log.warning("Reconnecting BLE printer %s failed: %s. Retrying in %d seconds", self.key, e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+def open_async(printer_cfg):
+    conn = printer_cfg.get("connection_data", {})
+    return AsyncBlePrinter(
+        conn.get("mac_address"),
+        name=conn.get("name"),
+        write_characteristic=conn.get("write_characteristic"),
+        chunk_size=conn.get("chunk_size"),
+        window=conn.get("window", DEFAULT_WINDOW),
+        pacing_ms=conn.get("pacing_ms", DEFAULT_PACING_MS),
+    )
+
+
+def _event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="ble-loop", daemon=True).start()
+        return _loop
+
+
+def _same_printer(device, printer_cfg):
+    conn = printer_cfg.get("connection_data", {})
+    return (conn.get("mac_address") or conn.get("name")) in (device.key, device.address)
+
+
+def write(data, printer_cfg, printer_id=None):
+    device = _devices.get(printer_id)
+    if device is None or not _same_printer(device, printer_cfg):
+        device = _devices[printer_id] = open_async(printer_cfg)
+    future = asyncio.run_coroutine_threadsafe(device.write(data), _event_loop())
+    try:
+        future.result(WRITE_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.cancel()  # Stop its chunks before the job is retried
+        raise
+
+
+def prepare(printers):
+    """Connect BLE printers in the background so the first ticket doesn't wait for it."""
+    for printer_id, cfg in printers.items():
+        if cfg.get("type") != "bluetooth-le" or printer_id in _devices:
+            continue
+        try:
+            device = _devices[printer_id] = open_async(cfg)
+        except ValueError as e:
+            log.warning("Bluetooth LE printer %s: %s. Skipping.", printer_id, e, extra={"printer_id": printer_id})
+            continue
+        _event_loop().call_soon_threadsafe(device.connect_in_background)
+
+
+def probe(printer_cfg, timeout=None):
+    """The link state of the printer's background connection, if it has one."""
+    for device in list(_devices.values()):
+        if _same_printer(device, printer_cfg):
+            return device.is_connected
+    return None
+
+
+def cleanup(printers):
+    """Disconnect printers that were removed or moved to another address."""
+    for printer_id, device in list(_devices.items()):
+        cfg = printers.get(printer_id)
+        if cfg is None or not _same_printer(device, cfg):
+            del _devices[printer_id]
+            asyncio.run_coroutine_threadsafe(device.close(), _event_loop())
@@ -0,0 +1,217 @@
+"""Classic Bluetooth (SPP) printers.
+
+Where Python has socket.AF_BLUETOOTH (Linux builds with BlueZ headers) the
+agent opens an RFCOMM socket straight to the printer: no /dev/rfcommX, no
+sudo, nothing to bind at startup. Set "bluetooth_mode" to "rfcomm" to force
+the serial-device path, or "socket" to require sockets.
+
+On the serial-device path every MAC address keeps the same /dev/rfcommX for
+good. The mapping is saved to rfcomm_map.json, so adding a printer never
+renumbers the others. Existing bindings are read with one `rfcomm -a` call;
+only missing or wrong ones are (re)bound, in parallel.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import threading
+
+log = logging.getLogger(__name__)
+
+BIND_WORKERS = 8
+CONNECT_TIMEOUT = 10
+RFCOMM_BINDING = re.compile(r"^rfcomm(\d+):\s+([0-9A-Fa-f:]{17})\s+channel\s+(\d+)")
+
+MODE = "auto"
+MAP_PATH = None
+BLUETOOTH_RFCOMM = {}  # Maps MAC address -> /dev/rfcommX, for bindings known to be good
+_indexes = {}  # MAC address -> rfcomm index, persisted in MAP_PATH
+_lock = threading.Lock()
+
+
+def configure(config, data_dir):
+    global MODE, MAP_PATH
+    MODE = config.get("bluetooth_mode", "auto")
+    MAP_PATH = os.path.join(data_dir, config.get("rfcomm_map_path", "rfcomm_map.json"))
+    try:
+        with open(MAP_PATH, "r", encoding="utf-8") as f:
+            _indexes.update({mac.upper(): int(index) for mac, index in json.load(f).items()})
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, AttributeError) as e:
+        log.warning("Ignoring unreadable %s: %s", MAP_PATH, e)
+
+
+def use_sockets():
+    if MODE == "socket":
+        return True
+    return MODE == "auto" and hasattr(socket, "AF_BLUETOOTH")
+
+
+def bluetooth_printers(printers):
+    """{MAC address: RFCOMM channel} for the classic Bluetooth printers"""
+    wanted = {}
+    for printer_id, cfg in printers.items():
+        if cfg.get("type") != "bluetooth":
+            continue
+        conn = cfg.get("connection_data", {})
+        mac_address = conn.get("mac_address")
+        if not mac_address:
+            log.warning("Bluetooth printer %s has no MAC address. Skipping.", printer_id, extra={"printer_id": printer_id})
+            continue
+        wanted[mac_address.upper()] = int(conn.get("channel", 1))
+    return wanted
+
+
+def current_bindings():
+    """{index: (MAC address, channel)} of the rfcomm devices bound right now"""
+    try:
+        output = subprocess.run(["rfcomm", "-a"], capture_output=True, text=True, check=False).stdout
+    except OSError as e:
+        log.warning("Could not list rfcomm bindings: %s", e)
+        return {}
+    bindings = {}
+    for line in output.splitlines():
+        match = RFCOMM_BINDING.match(line.strip())
+        if match:
+            bindings[int(match.group(1))] = (match.group(2).upper(), int(match.group(3)))
+    return bindings
+
+
+def assign_indexes(macs, bindings):
+    """Give new MAC addresses the lowest rfcomm index nobody else uses"""
+    with _lock:
+        new = [mac for mac in sorted(macs) if mac not in _indexes]
+        if not new:
+            return
+        taken = set(_indexes.values()) | {i for i, (mac, _) in bindings.items() if mac not in macs}
+        index = 0
+        for mac in new:
+            while index in taken:
+                index += 1
+            _indexes[mac] = index
+            taken.add(index)
+        save_indexes()
+
+
+def save_indexes():
+    if not MAP_PATH:
+        return
+    tmp_path = f"{MAP_PATH}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(_indexes, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, MAP_PATH)
+    except OSError as e:
+        log.warning("Could not save %s: %s", MAP_PATH, e)
+
+
+def bind(mac_address, index, channel, bound):
+    rfcomm_device = f"/dev/rfcomm{index}"
+    if bound is not None:
+        subprocess.run(["sudo", "rfcomm", "release", str(index)], check=False)
+    try:
+        subprocess.run(["sudo", "rfcomm", "bind", str(index), mac_address, str(channel)], check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.error("Failed to bind %s to %s: %s", mac_address, rfcomm_device, e)
+        return
+    log.info("Bound %s to %s", mac_address, rfcomm_device)
+    BLUETOOTH_RFCOMM[mac_address] = rfcomm_device
+
+
+def prepare(printers):
+    """Make sure every Bluetooth printer has a valid /dev/rfcommX (serial-device path only)"""
+    wanted = bluetooth_printers(printers)
+    if use_sockets() or not wanted:
+        return
+    bindings = current_bindings()
+    assign_indexes(wanted, bindings)
+    to_bind = []
+    for mac_address, channel in wanted.items():
+        index = _indexes[mac_address]
+        if bindings.get(index) == (mac_address, channel):
+            BLUETOOTH_RFCOMM[mac_address] = f"/dev/rfcomm{index}"
+        else:
+            to_bind.append((mac_address, index, channel, bindings.get(index)))
+    if not to_bind:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(BIND_WORKERS, len(to_bind))) as pool:
+        list(pool.map(lambda args: bind(*args), to_bind))
+
+
+def cleanup(printers):
+    """Release rfcomm devices whose MAC address no printer uses any more.
+
+    The index stays reserved, so the printer gets the same device if it
+    comes back.
+    """
+    for mac_address in set(BLUETOOTH_RFCOMM) - set(bluetooth_printers(printers)):
+        rfcomm_device = BLUETOOTH_RFCOMM.pop(mac_address)
+        subprocess.run(["sudo", "rfcomm", "release", rfcomm_device], check=False)
+        log.info("Released %s from %s", mac_address, rfcomm_device)
+
+
+class RfcommPrinter:
+    """A printer reached over a direct RFCOMM socket; pooled like escpos printers."""
+
+    def __init__(self, mac_address, channel=1, timeout=CONNECT_TIMEOUT):
+        self.mac_address = mac_address
+        self.channel = channel
+        self.timeout = timeout
+        self.device = None
+
+    def open(self):
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect((self.mac_address, self.channel))
+        except OSError:
+            sock.close()
+            raise
+        self.device = sock
+
+    def _raw(self, data):
+        self.device.sendall(data)
+
+    def close(self):
+        sock, self.device = self.device, None
+        if sock is not None:
+            sock.close()
+
+
+def probe(printer_cfg, timeout=CONNECT_TIMEOUT):
+    """Open and close an RFCOMM link, or check the rfcomm device is bound."""
+    conn = printer_cfg.get("connection_data", {})
+    mac_address = (conn.get("mac_address") or "").upper()
+    if not mac_address:
+        return None
+    if use_sockets():
+        p = RfcommPrinter(mac_address, int(conn.get("channel", 1)), timeout)
+        p.open()
+        p.close()
+        return True
+    rfcomm_device = BLUETOOTH_RFCOMM.get(mac_address)
+    return rfcomm_device is not None and os.path.exists(rfcomm_device)
+
+
+def open_printer(printer_cfg, printer_id=None):
+    conn = printer_cfg.get("connection_data", {})
+    mac_address = conn.get("mac_address")
+    if not mac_address:
+        raise ValueError(f"Bluetooth printer {printer_id}: No MAC address provided.")
+    if use_sockets():
+        p = RfcommPrinter(mac_address, int(conn.get("channel", 1)))
+        p.open()
+        return p
+    from escpos.printer import Serial
+
+    rfcomm_device = BLUETOOTH_RFCOMM.get(mac_address.upper())
+    if not rfcomm_device:
+        raise ValueError(f"No RFCOMM device mapped for {mac_address}")
+    p = Serial(devfile=rfcomm_device, baudrate=19200)
+    p.open()
+    return p
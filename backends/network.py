@@ -0,0 +1,92 @@
+import asyncio
+import socket
+
+from escpos.printer import Network
+
+from printer_pool import enable_keepalive
+
+# Seconds; a printer's connection_data "connect_timeout" and "write_timeout" override them
+CONNECT_TIMEOUT = 5
+WRITE_TIMEOUT = 30
+
+
+def address(printer_cfg):
+    conn = printer_cfg.get("connection_data", {})
+    return conn.get("ip_address") or conn.get("host"), int(conn.get("port", 9100))
+
+
+def timeouts(printer_cfg):
+    conn = printer_cfg.get("connection_data", {})
+    return float(conn.get("connect_timeout", CONNECT_TIMEOUT)), float(conn.get("write_timeout", WRITE_TIMEOUT))
+
+
+def open_printer(printer_cfg, printer_id=None):
+    host, port = address(printer_cfg)
+    connect_timeout, write_timeout = timeouts(printer_cfg)
+    p = Network(host, port=port, timeout=connect_timeout)
+    p.open()
+    p.device.settimeout(write_timeout)
+    return p
+
+
+def probe(printer_cfg, timeout=2):
+    socket.create_connection(address(printer_cfg), timeout).close()
+    return True
+
+
+def open_async(printer_cfg):
+    host, port = address(printer_cfg)
+    connect_timeout, write_timeout = timeouts(printer_cfg)
+    return AsyncNetworkPrinter(host, port, connect_timeout=connect_timeout, write_timeout=write_timeout)
+
+
+class AsyncNetworkPrinter:
+    """A raw TCP (port 9100) printer connection that stays open between jobs."""
+
+    def __init__(self, host, port=9100, connect_timeout=CONNECT_TIMEOUT, write_timeout=WRITE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.write_timeout = write_timeout
+        self._writer = None
+
+    async def write(self, data):
+        reused = self._writer is not None and not self._writer.is_closing()
+        if not reused:
+            await self._connect()
+        try:
+            await self._send(data)
+        except asyncio.TimeoutError:
+            raise  # Not a stale socket; don't write the ticket again
+        except (OSError, ConnectionError):
+            await self.close()
+            if not reused:
+                raise
+            await self._connect()  # The cached socket went stale; try once more
+            await self._send(data)
+
+    async def close(self, abort=False):
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            if abort:
+                writer.transport.abort()  # Drop unsent bytes; a printer that stopped reading never takes them
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ConnectionError):
+                pass
+
+    async def _send(self, data):
+        """Write data, closing the connection if the printer doesn't take it within write_timeout"""
+        self._writer.write(data)
+        try:
+            await asyncio.wait_for(self._writer.drain(), self.write_timeout)
+        except asyncio.TimeoutError:
+            await self.close(abort=True)
+            raise
+
+    async def _connect(self):
+        _, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.connect_timeout
+        )
+        enable_keepalive(self._writer.get_extra_info("socket"))
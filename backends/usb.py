@@ -0,0 +1,16 @@
+from escpos.printer import Usb
+
+
+def probe(printer_cfg, timeout=None):
+    """Whether the printer is on the USB bus; doesn't claim the device."""
+    import usb.core
+
+    conn = printer_cfg.get("connection_data", {})
+    return usb.core.find(idVendor=int(conn["vendor_id"], 16), idProduct=int(conn["product_id"], 16)) is not None
+
+
+def open_printer(printer_cfg, printer_id=None):
+    conn = printer_cfg.get("connection_data", {})
+    p = Usb(int(conn["vendor_id"], 16), int(conn["product_id"], 16))
+    p.open()
+    return p
@@ -0,0 +1,32 @@
+"""Printers that only pretend to print, for development and benchmarks.
+
+connection_data.simulate makes a virtual printer behave like a slow one:
+{"connect_latency_ms": 30, "write_latency_ms": 5, "per_byte_us": 50,
+"failure_rate": 0.01}. write_latency_ms is paid on every write, like the
+round trip of a serial or Bluetooth link.
+"""
+
+import logging
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+SIMULATED_CONNECTED = set()
+
+
+def write(data, printer_cfg, printer_id=None):
+    simulate = printer_cfg.get("connection_data", {}).get("simulate")
+    if simulate:
+        if printer_id not in SIMULATED_CONNECTED:
+            time.sleep(simulate.get("connect_latency_ms", 0) / 1000)
+            SIMULATED_CONNECTED.add(printer_id)
+        if random.random() < simulate.get("failure_rate", 0):
+            SIMULATED_CONNECTED.discard(printer_id)
+            raise ConnectionError("simulated printer failure")
+        time.sleep(simulate.get("write_latency_ms", 0) / 1000 + len(data) * simulate.get("per_byte_us", 0) / 1e6)
+    log.debug("Printing %d bytes on printer '%s'", len(data), printer_id, extra={"printer_id": printer_id})
+
+
+def cleanup(printers):
+    SIMULATED_CONNECTED.intersection_update(printers)
@@ -0,0 +1,45 @@
+"""Printers shared through the Windows spooler, written to in RAW mode."""
+
+from metrics import WRITE_TIME
+
+# GetPrinter level 2 Status and Attributes bits that mean jobs won't print
+PRINTER_STATUS_DOWN = 0x2 | 0x10 | 0x80  # error, paper out, offline
+PRINTER_ATTRIBUTE_WORK_OFFLINE = 0x400
+
+# Windows printer by name (requires pywin32)
+try:
+    import win32print
+except ImportError:
+    win32print = None
+
+
+def printer_name(printer_cfg):
+    conn = printer_cfg.get("connection_data", {})
+    return conn.get("windows_printer_name") or printer_cfg.get("name")
+
+
+def probe(printer_cfg, timeout=None):
+    """What the spooler knows about the printer; it may lag for USB printers."""
+    if win32print is None:
+        return None
+    hPrinter = win32print.OpenPrinter(printer_name(printer_cfg))
+    try:
+        info = win32print.GetPrinter(hPrinter, 2)
+    finally:
+        win32print.ClosePrinter(hPrinter)
+    return not (info["Status"] & PRINTER_STATUS_DOWN or info["Attributes"] & PRINTER_ATTRIBUTE_WORK_OFFLINE)
+
+
+def write(data, printer_cfg, printer_id=None):
+    if win32print is None:
+        raise RuntimeError("win32print module is not available, cannot print to a Windows printer.")
+    hPrinter = win32print.OpenPrinter(printer_name(printer_cfg))
+    try:
+        with WRITE_TIME.time(printer_id=printer_id):
+            win32print.StartDocPrinter(hPrinter, 1, ("Receipt", None, "RAW"))
+            win32print.StartPagePrinter(hPrinter)
+            win32print.WritePrinter(hPrinter, data)
+            win32print.EndPagePrinter(hPrinter)
+            win32print.EndDocPrinter(hPrinter)
+    finally:
+        win32print.ClosePrinter(hPrinter)
@@ -0,0 +1,125 @@
+"""Index of printed jobs, so redelivered messages are acked without printing.
+
+RabbitMQ redelivers a message whenever its ack is lost: the agent crashed
+after the cut, or the connection died on a missed heartbeat. Each printed
+job's fingerprint (its AMQP message_id, else a hash of the body) goes into
+a DedupIndex before the ack is sent. The consumer checks the index before
+queueing a job that may be a copy, see may_be_duplicate().
+
+Lookups are dict lookups. Entries expire after ttl seconds and the oldest
+are dropped beyond max_entries. The index persists as an append-only file
+that is compacted on load and whenever it grows to twice max_entries.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def fingerprint(properties, body):
+    """Identity of a message across redeliveries: its message_id, else its content."""
+    message_id = getattr(properties, "message_id", None)
+    if message_id:
+        return f"id:{message_id}"
+    return "sha256:" + hashlib.sha256(body).hexdigest()
+
+
+def may_be_duplicate(properties, redelivered):
+    """Whether a delivery may be a copy of a job already printed.
+
+    Only a redelivery or a message with a message_id can be. Without one,
+    a fresh message that hashes like a printed one is a second ticket with
+    the same content (a reprint, two identical orders) and must print.
+    """
+    return bool(redelivered or getattr(properties, "message_id", None))
+
+
+class DedupIndex:
+    def __init__(self, path=None, ttl=86400, max_entries=100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # fingerprint -> time added, oldest first
+        self._lock = threading.Lock()
+        self._file = None
+        self._lines = 0
+        if path:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def seen(self, fingerprint):
+        added = self._entries.get(fingerprint)
+        return added is not None and time.time() - added < self.ttl
+
+    def add(self, fingerprint):
+        """Record a printed job; on disk (in the OS cache) when this returns."""
+        now = time.time()
+        with self._lock:
+            self._entries.pop(fingerprint, None)
+            self._entries[fingerprint] = now
+            self._expire(now)
+            if self._file is None:
+                return
+            try:
+                self._file.write(f"{now:.3f} {fingerprint}\n")
+                self._file.flush()
+                self._lines += 1
+                if self._lines > 2 * self.max_entries:
+                    self._compact()
+            except OSError as e:
+                log.warning("Could not persist dedup entry: %s", e)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _expire(self, now):
+        entries = self._entries
+        while entries and (len(entries) > self.max_entries or now - next(iter(entries.values())) >= self.ttl):
+            entries.popitem(last=False)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    added, _, fp = line.rstrip("\n").partition(" ")
+                    try:
+                        added = float(added)
+                    except ValueError:
+                        continue  # A torn last line after a crash
+                    if fp:
+                        self._entries.pop(fp, None)
+                        self._entries[fp] = added
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning("Could not load dedup index %s: %s", self.path, e)
+        self._expire(time.time())
+        try:
+            self._compact()
+        except OSError as e:
+            log.warning("Could not open dedup index %s, keeping it in memory only: %s", self.path, e)
+        log.info("Loaded %d printed job fingerprint(s) from %s", len(self._entries), self.path)
+
+    def _compact(self):
+        """Rewrite the file with only the live entries and reopen it for appending."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(f"{added:.3f} {fp}\n" for fp, added in self._entries.items())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._lines = len(self._entries)
@@ -0,0 +1,211 @@
+import functools
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from metrics import JOBS, TIME_IN_QUEUE
+
+log = logging.getLogger(__name__)
+
+# Handler results besides True (printed) and False (failed)
+MOVED = "moved"  # Handed to another printer's queue, which settles it
+DUPLICATE = "duplicate"  # A copy of a job printed while it waited; settled like a printed job
+GONE = "gone"  # Its delivery died with its channel and the broker redelivers it; nothing to settle
+
+
+class PrintJob:
+    """A print job received from RabbitMQ, waiting for its printer's worker.
+
+    Jobs printed from the journal carry its entry instead of an acker; their
+    delivery was acked when they were journaled.
+    """
+
+    def __init__(self, acker, delivery_tag, printer_id, message, properties=None, body=None, entry=None,
+                 lane="normal", redelivered=False):
+        self.acker = acker
+        self.delivery_tag = delivery_tag
+        self.printer_id = printer_id
+        self.message = message
+        self.properties = properties
+        self.body = body
+        self.entry = entry
+        self.lane = lane
+        self.redelivered = redelivered
+        self.enqueued_at = time.monotonic()
+
+
+def printer_queue_size(config):
+    """Jobs one printer may queue: "printer_queue_size", capped to half the prefetch window.
+
+    A printer holds its queued jobs plus the batch it is printing, all
+    unacked. Kept under half of prefetch_count, a jammed printer can't take
+    the whole window and stop deliveries for every other printer.
+    """
+    share = max(1, config.get("prefetch_count", 50) // 2 - config.get("batch_max_jobs", 1))
+    size = config.get("printer_queue_size", share)
+    if size > share:
+        log.warning("printer_queue_size %d would let one printer fill the prefetch window; using %d", size, share)
+        return share
+    return max(1, size)
+
+
+def run_on_connection_thread(channel, callback):
+    """Schedule callback on the pika connection thread that owns channel.
+
+    pika channels are not thread-safe, so workers must never ack or nack
+    directly. If the connection is already gone the delivery tag is dead
+    anyway and RabbitMQ will redeliver the message.
+    """
+    try:
+        channel.connection.add_callback_threadsafe(callback)
+    except Exception as e:
+        log.warning("Could not schedule callback on RabbitMQ connection: %s", e)
+
+
+class PrinterDispatcher:
+    """Runs print jobs on one worker thread per printer_id.
+
+    Each printer gets its own bounded queue, so a jammed or unreachable
+    printer only delays its own tickets while the other printers keep
+    printing in parallel. Jobs run in FIFO order, or by their lane's
+    deadline with a priority.PriorityPolicy. handler(job) runs on the worker thread and returns
+    True when the job printed. on_success(job) (default: ack), or
+    on_failure(job, reason) for a failed job (default: nack and requeue),
+    then runs on the connection thread, or right on the worker thread for
+    journaled jobs, which have no delivery to settle. A handler that
+    submitted the job to another printer's queue returns MOVED instead, and
+    the job is left for that printer's worker to settle. DUPLICATE settles
+    like success without counting as printed; GONE settles nothing.
+
+    With batch_max_jobs > 1 a worker takes up to that many jobs at once:
+    whatever is already queued for its printer, plus what arrives within
+    batch_window seconds of the first. batch_handler(jobs) prints them and
+    returns one result per job; a batch's acks go to the connection thread
+    in a single callback.
+    """
+
+    def __init__(self, handler, max_queue_size=100, on_failure=None, on_success=None, batch_handler=None,
+                 batch_window=0, batch_max_jobs=1, priorities=None):
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.on_failure = on_failure
+        self.on_success = on_success
+        self.batch_handler = batch_handler
+        self.batch_window = batch_window
+        self.batch_max_jobs = batch_max_jobs if batch_handler is not None else 1
+        self.priorities = priorities
+        self._sequence = itertools.count()  # Keeps equal deadlines FIFO
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Queue a job for its printer. Returns False if that queue is full."""
+        job.enqueued_at = time.monotonic()  # Retried journaled jobs are submitted again
+        if self.priorities is not None:
+            deadline = self.priorities.deadline(job.lane, job.enqueued_at)
+        else:
+            deadline = job.enqueued_at
+        try:
+            self._queue_for(job.printer_id).put_nowait((deadline, next(self._sequence), job))
+            return True
+        except queue.Full:
+            return False
+
+    def queue_depths(self):
+        with self._lock:
+            return {printer_id: q.qsize() for printer_id, q in self._queues.items()}
+
+    def _queue_for(self, printer_id):
+        with self._lock:
+            q = self._queues.get(printer_id)
+            if q is None:
+                q = queue.PriorityQueue(maxsize=self.max_queue_size)
+                self._queues[printer_id] = q
+                worker = threading.Thread(
+                    target=self._worker,
+                    args=(printer_id, q),
+                    name=f"printer-{printer_id}",
+                    daemon=True,
+                )
+                worker.start()
+            return q
+
+    def _take(self, q):
+        """The next job, plus more for the same printer that are queued or arrive within the batch window"""
+        jobs = [q.get()[-1]]
+        deadline = time.monotonic() + self.batch_window
+        while len(jobs) < self.batch_max_jobs:
+            remaining = deadline - time.monotonic()
+            try:
+                jobs.append((q.get(timeout=remaining) if remaining > 0 else q.get_nowait())[-1])
+            except queue.Empty:
+                break
+        return jobs
+
+    def _worker(self, printer_id, q):
+        while True:
+            jobs = self._take(q)
+            started = time.monotonic()
+            for job in jobs:
+                TIME_IN_QUEUE.observe(started - job.enqueued_at, printer_id=printer_id)
+            reason = "print failed"
+            try:
+                if len(jobs) == 1:
+                    results = [self.handler(jobs[0])]
+                else:
+                    results = self.batch_handler(jobs)
+            except Exception as e:
+                log.exception("Worker for printer '%s' failed", printer_id, extra={"printer_id": printer_id})
+                results = [False] * len(jobs)
+                reason = str(e)
+            duration_ms = round((time.monotonic() - started) * 1000, 1)
+            callbacks = {}  # channel -> settle callbacks
+            for job, success in zip(jobs, results):
+                if success in (MOVED, GONE):
+                    JOBS.inc(printer_id=printer_id, result=success)
+                    log.info("Moved" if success == MOVED else "Delivery gone -- Not printed",
+                             extra={"printer_id": printer_id, "delivery_tag": job.delivery_tag})
+                    continue
+                if success == DUPLICATE:
+                    JOBS.inc(printer_id=printer_id, result=DUPLICATE)
+                    message = "Duplicate of a printed job -- Acking without printing"
+                else:
+                    JOBS.inc(printer_id=printer_id, result="success" if success else "failure")
+                    message = "Printed" if success else "Print failed"
+                log.info(
+                    message,
+                    extra={
+                        "printer_id": printer_id,
+                        "delivery_tag": job.delivery_tag,
+                        "queued_ms": round((started - job.enqueued_at) * 1000, 1),
+                        "duration_ms": duration_ms,
+                        "batch_size": len(jobs),
+                        "lane": job.lane,
+                    },
+                )
+                callback = self._settle_callback(job, success, reason)
+                if job.acker is None:
+                    try:
+                        callback()
+                    except Exception:
+                        log.exception("Could not settle job for printer '%s'", printer_id, extra={"printer_id": printer_id})
+                else:
+                    callbacks.setdefault(job.acker.channel, []).append(callback)
+            for channel, settle in callbacks.items():
+                run_on_connection_thread(channel, functools.partial(_run_all, settle))
+
+    def _settle_callback(self, job, success, reason):
+        if success and self.on_success is not None:
+            return functools.partial(self.on_success, job)
+        if success:
+            return functools.partial(job.acker.ack, job.delivery_tag)
+        if self.on_failure is not None:
+            return functools.partial(self.on_failure, job, reason)
+        return functools.partial(job.acker.nack, job.delivery_tag, requeue=True)
+
+
+def _run_all(callbacks):
+    for callback in callbacks:
+        callback()
@@ -0,0 +1,162 @@
+"""Printer health: one circuit breaker per printer, fed by jobs and probes.
+
+Every print updates its printer's breaker. After failure_threshold
+failures in a row the breaker opens and the printer is reported down, so
+its jobs are held or sent to its fallback printer right away instead of
+each one waiting out a connect timeout. A successful probe or print
+closes the breaker again. Once it has been open for open_seconds, the
+printer's next job is let through as a trial ("half-open"), so printers
+nothing can probe still come back.
+
+HealthMonitor probes every printer in the background, in parallel, with
+its backend's probe().
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, open_seconds=10):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.reason = None
+
+    def success(self):
+        """Record a success; returns True if that closed the breaker."""
+        was_closed = self.state == CLOSED
+        self.state = CLOSED
+        self.failures = 0
+        self.reason = None
+        return not was_closed
+
+    def failure(self, reason):
+        """Record a failure; returns True if that opened the breaker."""
+        self.failures += 1
+        self.reason = reason
+        if self.state == OPEN:
+            return False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def allow(self):
+        """Whether a job may try the printer now."""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+
+class PrinterHealth:
+    """Circuit breakers by printer_id."""
+
+    def __init__(self, failure_threshold=3, open_seconds=10):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, printer_id):
+        breaker = self._breakers.get(printer_id)
+        if breaker is None:
+            breaker = self._breakers[printer_id] = CircuitBreaker(self.failure_threshold, self.open_seconds)
+        return breaker
+
+    def success(self, printer_id):
+        with self._lock:
+            closed = self._breaker(printer_id).success()
+        if closed:
+            log.info("Printer '%s' is back up", printer_id, extra={"printer_id": printer_id})
+
+    def failure(self, printer_id, reason):
+        with self._lock:
+            breaker = self._breaker(printer_id)
+            opened = breaker.failure(reason)
+            failures = breaker.failures
+        if opened:
+            log.warning("Printer '%s' is down after %d failure(s): %s", printer_id, failures, reason,
+                        extra={"printer_id": printer_id})
+
+    def available(self, printer_id):
+        with self._lock:
+            return self._breaker(printer_id).allow()
+
+    def is_down(self, printer_id):
+        with self._lock:
+            breaker = self._breakers.get(printer_id)
+            return breaker is not None and breaker.state == OPEN
+
+    def states(self):
+        """{printer_id: 1 if up, 0 if down}, for the pos_agent_printer_up gauge."""
+        with self._lock:
+            return {printer_id: int(breaker.state != OPEN) for printer_id, breaker in self._breakers.items()}
+
+    def prune(self, printers):
+        with self._lock:
+            for printer_id in set(self._breakers) - set(printers):
+                del self._breakers[printer_id]
+
+
+class HealthMonitor:
+    """Probes printers every `interval` seconds and feeds the results to health.
+
+    probe(printer_id, printer_cfg) returns True if the printer answered,
+    False or raises if it didn't, and None when there is nothing to tell
+    (no probe for its type, or it's busy printing).
+    """
+
+    def __init__(self, health, get_printers, probe, interval=15, workers=8):
+        self.health = health
+        self.get_printers = get_printers
+        self.probe = probe
+        self.interval = interval
+        self.workers = workers
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval:
+            self._thread = threading.Thread(target=self._run, name="printer-health", daemon=True)
+            self._thread.start()
+
+    def check_all(self):
+        printers = self.get_printers() or {}
+        self.health.prune(printers)
+        if not printers:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(printers))) as pool:
+            list(pool.map(lambda item: self.check(*item), printers.items()))
+
+    def check(self, printer_id, printer_cfg):
+        try:
+            up = self.probe(printer_id, printer_cfg)
+        except Exception as e:
+            log.debug("Probe of printer '%s' failed: %s", printer_id, e, extra={"printer_id": printer_id})
+            self.health.failure(printer_id, f"probe failed: {e}")
+            return
+        if up is None:
+            return
+        if up:
+            self.health.success(printer_id)
+        else:
+            self.health.failure(printer_id, "probe failed")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)  # Startup's connection prewarm reports first
+            try:
+                self.check_all()
+            except Exception as e:
+                log.exception("Printer health check failed: %s", e)
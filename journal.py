@@ -0,0 +1,201 @@
+"""On-disk journal of accepted print jobs.
+
+With "journal_path" set, the agent writes every print job to a SQLite
+database (WAL mode) and acks the delivery as soon as the job is on disk.
+Printing then runs from the journal: a broker outage no longer stops jobs
+that were already received, and jobs left pending when the agent stopped
+are printed after a restart.
+
+Writes go through one writer thread that commits in batches, so a burst of
+tickets costs one fsync rather than one per ticket. Fingerprints of printed
+jobs are kept for keep_done seconds, so a redelivered message is recognised
+and acked without printing a second ticket.
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+DEAD = "dead"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL UNIQUE,
+    printer_id TEXT,
+    body BLOB,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, updated);
+"""
+
+
+class JournalEntry:
+    def __init__(self, job_id, fingerprint, printer_id, body, attempts=0):
+        self.job_id = job_id
+        self.fingerprint = fingerprint
+        self.printer_id = printer_id
+        self.body = body
+        self.attempts = attempts
+
+
+class Journal:
+    def __init__(self, path, commit_interval=0.01, max_batch=256, keep_done=7 * 86400):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.keep_done = keep_done
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")  # Each batch commit is durable
+        self._db.executescript(SCHEMA)
+        self._db_lock = threading.Lock()
+        self._states = dict(self._db.execute("SELECT fingerprint, state FROM jobs"))
+        self._lock = threading.Lock()
+        self._ops = queue.Queue()
+        self._last_prune = 0
+        self._writer = threading.Thread(target=self._write_loop, name="journal-writer", daemon=True)
+        self._writer.start()
+
+    def state(self, fingerprint):
+        with self._lock:
+            return self._states.get(fingerprint)
+
+    def append(self, fingerprint, printer_id, body, on_committed, unique=False):
+        """Record an accepted job.
+
+        Returns False without writing anything if the fingerprint is already
+        journaled, unless unique says the job is known to be new: then it is
+        journaled as "<fingerprint>#2", "#3", ... Otherwise on_committed(entry,
+        error) runs on the writer thread once the job is on disk, or with the
+        error if it could not be written.
+        """
+        with self._lock:
+            if fingerprint in self._states:
+                if not unique:
+                    return False
+                base, n = fingerprint, 2
+                while f"{base}#{n}" in self._states:
+                    n += 1
+                fingerprint = f"{base}#{n}"
+            self._states[fingerprint] = PENDING
+        self._ops.put(("append", JournalEntry(None, fingerprint, printer_id, body), on_committed))
+        return True
+
+    def complete(self, entry):
+        self._set_state(entry, DONE)
+        self._ops.put(("done", entry, None))
+
+    def failed(self, entry, error):
+        entry.attempts += 1
+        self._ops.put(("failed", entry, str(error)))
+
+    def dead(self, entry, error):
+        self._set_state(entry, DEAD)
+        self._ops.put(("dead", entry, str(error)))
+
+    def pending(self):
+        """Jobs that were journaled but never printed, oldest first."""
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT id, fingerprint, printer_id, body, attempts FROM jobs WHERE state = ? ORDER BY id", (PENDING,)
+            ).fetchall()
+        return [JournalEntry(*row) for row in rows]
+
+    def close(self):
+        done = threading.Event()
+        self._ops.put(("flush", None, done.set))
+        done.wait(5)
+        with self._db_lock:
+            self._db.close()
+
+    def _set_state(self, entry, state):
+        with self._lock:
+            self._states[entry.fingerprint] = state
+
+    def _write_loop(self):
+        while True:
+            batch = [self._ops.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._ops.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            error = None
+            try:
+                with self._db_lock:
+                    self._db.execute("BEGIN")
+                    try:
+                        for op in batch:
+                            self._apply(*op)
+                        self._db.execute("COMMIT")
+                    except Exception:
+                        self._db.execute("ROLLBACK")
+                        raise
+            except Exception as e:
+                log.exception("Journal write of %d operation(s) failed", len(batch))
+                error = e
+            for op, entry, callback in batch:
+                if op == "append":
+                    if error is not None:
+                        with self._lock:
+                            self._states.pop(entry.fingerprint, None)
+                    callback(entry, error)
+                elif op == "flush":
+                    callback()
+            self._prune()
+
+    def _apply(self, op, entry, argument):
+        now = time.time()
+        if op == "append":
+            cursor = self._db.execute(
+                "INSERT INTO jobs (fingerprint, printer_id, body, state, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (entry.fingerprint, entry.printer_id, entry.body, PENDING, now, now),
+            )
+            entry.job_id = cursor.lastrowid
+        elif op == "done":
+            # The fingerprint is all a printed job still needs
+            self._db.execute("UPDATE jobs SET state = ?, body = NULL, updated = ? WHERE id = ?", (DONE, now, entry.job_id))
+        elif op == "failed":
+            self._db.execute(
+                "UPDATE jobs SET attempts = attempts + 1, error = ?, updated = ? WHERE id = ?",
+                (argument, now, entry.job_id),
+            )
+        elif op == "dead":
+            self._db.execute("UPDATE jobs SET state = ?, error = ?, updated = ? WHERE id = ?", (DEAD, argument, now, entry.job_id))
+
+    def _prune(self):
+        now = time.time()
+        if now - self._last_prune < 3600:
+            return
+        self._last_prune = now
+        cutoff = now - self.keep_done
+        try:
+            with self._db_lock:
+                expired = [row[0] for row in self._db.execute(
+                    "SELECT fingerprint FROM jobs WHERE state != ? AND updated < ?", (PENDING, cutoff)
+                )]
+                self._db.execute("DELETE FROM jobs WHERE state != ? AND updated < ?", (PENDING, cutoff))
+        except sqlite3.Error as e:
+            log.warning("Could not prune the journal: %s", e)
+            return
+        with self._lock:
+            for fp in expired:
+                if self._states.get(fp) != PENDING:
+                    self._states.pop(fp, None)
+        if expired:
+            log.info("Pruned %d finished job(s) from the journal", len(expired))
@@ -0,0 +1,193 @@
+"""In-process metrics in the Prometheus text format.
+
+serve() exposes them at http://127.0.0.1:<metrics_port>/metrics. Metrics are
+plain counters and histograms behind one lock, so recording one on the print
+path costs a dict update and never does I/O.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Gauge:
+    """A gauge read from a callback at scrape time.
+
+    The callback returns a single number or a {label_value: number} dict for
+    a gauge with one label.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._function = None
+        _metrics.append(self)
+
+    def set_function(self, function):
+        self._function = function
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        if self._function is None:
+            return
+        try:
+            values = self._function()
+        except Exception:
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items(), key=lambda item: str(item[0])):
+            if not isinstance(key, tuple):
+                key = (str(key),)
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [bucket counts..., sum, count]
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, state in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", repr(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+            yield f"{self.name}_bucket{labels} {state[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}"
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+JOBS = Counter("pos_agent_jobs_total", "Print jobs finished, by printer and result.", ["printer_id", "result"])
+REDELIVERIES = Counter(
+    "pos_agent_redeliveries_total",
+    "Deliveries sent to a delay queue (retry or hold) or the dead-letter queue.",
+    ["outcome"],
+)
+PRINTER_UP = Gauge("pos_agent_printer_up", "0 while a printer's circuit breaker is open, else 1.", ["printer_id"])
+PRINTER_READY = Gauge("pos_agent_printer_ready", "0 while a printer reports a problem it can't print through, else 1.",
+                      ["printer_id"])
+QUEUE_DEPTH = Gauge("pos_agent_queue_depth", "Jobs waiting in each printer's local queue.", ["printer_id"])
+TIME_IN_QUEUE = Histogram(
+    "pos_agent_time_in_queue_seconds", "Time from delivery until a printer worker picks the job up.", ["printer_id"]
+)
+RENDER_TIME = Histogram("pos_agent_render_seconds", "Time to compile a message to ESC/POS bytes.", ["printer_id"])
+CONNECT_TIME = Histogram("pos_agent_connect_seconds", "Time to open a printer connection.", ["printer_id"])
+WRITE_TIME = Histogram("pos_agent_write_seconds", "Time to write a job's bytes to the printer.", ["printer_id"])
+
+
+def render_text():
+    with _lock:
+        lines = [line for metric in _metrics for line in metric.collect()]
+    return "\n".join(lines) + "\n"
+
+
+def serve(port, host="127.0.0.1"):
+    """Serve /metrics, and recent log events at /events, on a daemon thread."""
+    from flask import Flask, Response, jsonify, request
+
+    from agent_logging import EVENTS
+    from werkzeug.serving import make_server
+
+    app = Flask("pos_agent_metrics")
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render_text(), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/events")
+    def events():
+        try:
+            matched = EVENTS.query(
+                level=request.args.get("level"),
+                printer_id=request.args.get("printer_id"),
+                contains=request.args.get("contains"),
+                limit=request.args.get("limit", 100, type=int),
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(matched)
+
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return app
@@ -0,0 +1,48 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def diff_printers(old, new):
+    """Return the (added, changed, removed) printer names between two maps."""
+    old = old or {}
+    added = {name for name in new if name not in old}
+    removed = {name for name in old if name not in new}
+    changed = {name for name in new if name in old and new[name] != old[name]}
+    return added, changed, removed
+
+
+class BackgroundReloader:
+    """Runs reload() off the consumer thread, one reload at a time.
+
+    Requests that arrive while a reload is running are folded into a single
+    follow-up reload, so a burst of printer update messages costs at most
+    two round trips to the backend.
+    """
+
+    def __init__(self, reload):
+        self._reload = reload
+        self._lock = threading.Lock()
+        self._running = False
+        self._pending = False
+
+    def request(self):
+        with self._lock:
+            if self._running:
+                self._pending = True
+                return
+            self._running = True
+        threading.Thread(target=self._run, name="printer-reload", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self._reload()
+            except Exception as e:
+                log.exception("Printer reload failed, keeping current printers: %s", e)
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                self._pending = False
@@ -0,0 +1,285 @@
+import json
+import logging
+import select
+import socket
+import threading
+import time
+
+from metrics import CONNECT_TIME, WRITE_TIME
+
+log = logging.getLogger(__name__)
+
+# TCP keepalive on pooled sockets: a printer that was switched off or restarted
+# since its last job is noticed within about KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT
+# seconds, instead of the next ticket vanishing into a half-open socket
+KEEPALIVE_IDLE = 2
+KEEPALIVE_INTERVAL = 1
+KEEPALIVE_COUNT = 3
+
+
+def connection_key(printer_cfg):
+    """Identity of the physical connection described by a printer config."""
+    conn = printer_cfg.get("connection_data", {})
+    return printer_cfg.get("type"), json.dumps(conn, sort_keys=True)
+
+
+def is_alive(printer):
+    """Cheap, non-blocking check that an open escpos printer is still usable."""
+    device = printer.device
+    if not device:
+        return False
+    if isinstance(device, socket.socket):
+        try:
+            readable, _, _ = select.select([device], [], [], 0)
+            # A readable socket with nothing to read means the printer hung up.
+            # Anything else is unsolicited status bytes, which we discard.
+            if readable and device.recv(64) == b"":
+                return False
+        except (OSError, ValueError):
+            return False
+        return True
+    is_open = getattr(device, "is_open", None)  # pyserial
+    if is_open is not None:
+        return bool(is_open)
+    return True
+
+
+def enable_keepalive(device):
+    """Probe an idle printer socket often, so a dead printer shows before the next job.
+
+    Takes a socket or asyncio's socket wrapper; ignores other devices.
+    """
+    if getattr(device, "type", None) != socket.SOCK_STREAM or not hasattr(device, "setsockopt"):
+        return
+    try:
+        device.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):  # Linux
+            device.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+            device.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+            device.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+        elif hasattr(socket, "SIO_KEEPALIVE_VALS") and hasattr(device, "ioctl"):  # Windows
+            device.ioctl(socket.SIO_KEEPALIVE_VALS, (1, KEEPALIVE_IDLE * 1000, KEEPALIVE_INTERVAL * 1000))
+        elif hasattr(socket, "TCP_KEEPALIVE"):  # macOS
+            device.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, KEEPALIVE_IDLE)
+    except OSError as e:
+        log.debug("Could not enable TCP keepalive: %s", e)  # e.g. RFCOMM sockets
+
+
+def close_quietly(printer):
+    try:
+        printer.close()
+    except Exception as e:
+        log.warning("Error closing printer connection: %s", e)
+
+
+class _Entry:
+    def __init__(self, key, printer):
+        self.key = key
+        self.printer = printer
+        self.last_used = time.monotonic()
+        self.in_use = False
+        self.stale = False
+
+
+class PrinterConnectionPool:
+    """Keeps one open connection per printer between jobs.
+
+    Connections are cached by printer name and checked against the printer's
+    type and connection_data on every checkout, so a changed config opens a
+    new connection. Dead or idle connections are closed and reopened on
+    demand, and a connection that fails mid-job is retried once on a fresh
+    handle.
+
+    One caller at a time uses a printer's connection; run() waits up to
+    busy_timeout seconds for the one before it, so two writers never
+    interleave their bytes on one device.
+    """
+
+    def __init__(self, idle_timeout=300, busy_timeout=60):
+        self.idle_timeout = idle_timeout
+        self.busy_timeout = busy_timeout
+        self._entries = {}
+        self._users = {}  # printer_id -> lock held while a caller uses its connection
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def run(self, printer_id, printer_cfg, opener, action):
+        """Call action(printer) with a pooled connection opened by opener; returns its result."""
+        user = self._user_lock(printer_id)
+        if not user.acquire(timeout=self.busy_timeout):
+            raise TimeoutError(f"connection to printer '{printer_id}' busy for {self.busy_timeout} s")
+        try:
+            return self._run(printer_id, printer_cfg, opener, action)
+        finally:
+            user.release()
+
+    def _run(self, printer_id, printer_cfg, opener, action):
+        entry, reused = self._checkout(printer_id, printer_cfg, opener)
+        try:
+            with WRITE_TIME.time(printer_id=printer_id):
+                result = action(entry.printer)
+        except Exception as e:
+            self._discard(printer_id, entry)
+            if not reused:
+                raise
+            log.warning(
+                "Cached connection to printer '%s' failed (%s). Reconnecting...", printer_id, e,
+                extra={"printer_id": printer_id},
+            )
+            entry, _ = self._checkout(printer_id, printer_cfg, opener)
+            try:
+                with WRITE_TIME.time(printer_id=printer_id):
+                    result = action(entry.printer)
+            except Exception:
+                self._discard(printer_id, entry)
+                raise
+        self._checkin(printer_id, entry)
+        return result
+
+    def run_if_idle(self, printer_id, printer_cfg, action, opener=None):
+        """Call action(printer) on the printer's connection unless another caller is using it.
+
+        Returns (ran, result). Without opener only an open connection is
+        used, and that doesn't count as use, so idle connections still get
+        closed after idle_timeout. With opener it works like run().
+        """
+        user = self._user_lock(printer_id)
+        if not user.acquire(blocking=False):
+            return False, None
+        try:
+            if opener is not None:
+                return True, self._run(printer_id, printer_cfg, opener, action)
+            with self._lock:
+                entry = self._entries.get(printer_id)
+                if entry is None or entry.in_use or entry.stale or entry.key != connection_key(printer_cfg):
+                    return False, None
+                entry.in_use = True
+            try:
+                result = action(entry.printer)
+            except Exception:
+                self._discard(printer_id, entry)
+                raise
+            with self._lock:
+                entry.in_use = False
+                stale = entry.stale and self._entries.get(printer_id) is entry
+                if stale:
+                    del self._entries[printer_id]
+            if stale:
+                close_quietly(entry.printer)
+            return True, result
+        finally:
+            user.release()
+
+    def warm(self, printer_id, printer_cfg, opener):
+        """Open a printer's connection ahead of its first job, unless it has one or a job is opening it."""
+        user = self._user_lock(printer_id)
+        if not user.acquire(blocking=False):
+            return
+        try:
+            if self.has_connection(printer_id):
+                return
+            with CONNECT_TIME.time(printer_id=printer_id):
+                printer = opener(printer_cfg, printer_id)
+            enable_keepalive(getattr(printer, "device", None))
+            with self._lock:
+                self._entries[printer_id] = _Entry(connection_key(printer_cfg), printer)
+                self._start_reaper()
+        finally:
+            user.release()
+
+    def has_connection(self, printer_id):
+        """Whether the printer has a pooled connection, open or in use."""
+        with self._lock:
+            entry = self._entries.get(printer_id)
+            return entry is not None and not entry.stale
+
+    def invalidate(self, printer_id):
+        """Close a printer's connection, or mark it to close once its job ends."""
+        with self._lock:
+            entry = self._entries.get(printer_id)
+            if entry is None:
+                return
+            if entry.in_use:
+                entry.stale = True
+                return
+            del self._entries[printer_id]
+        close_quietly(entry.printer)
+
+    def prune(self, printers):
+        """Invalidate connections for printers that were removed or changed."""
+        with self._lock:
+            cached = {printer_id: entry.key for printer_id, entry in self._entries.items()}
+        for printer_id, key in cached.items():
+            cfg = printers.get(printer_id)
+            if cfg is None or connection_key(cfg) != key:
+                self.invalidate(printer_id)
+
+    def close_all(self):
+        with self._lock:
+            printer_ids = list(self._entries)
+        for printer_id in printer_ids:
+            self.invalidate(printer_id)
+
+    def _user_lock(self, printer_id):
+        with self._lock:
+            user = self._users.get(printer_id)
+            if user is None:
+                user = self._users[printer_id] = threading.Lock()
+            return user
+
+    def _checkout(self, printer_id, printer_cfg, opener):
+        """The printer's connection, reused or newly opened; the caller holds its user lock."""
+        key = connection_key(printer_cfg)
+        with self._lock:
+            entry = self._entries.get(printer_id)
+            if entry is not None:
+                entry.in_use = True  # Keeps the reaper off it
+        if entry is not None:
+            if entry.key == key and not entry.stale and is_alive(entry.printer):
+                return entry, True
+            self._discard(printer_id, entry)
+
+        with CONNECT_TIME.time(printer_id=printer_id):
+            printer = opener(printer_cfg, printer_id)
+        enable_keepalive(getattr(printer, "device", None))
+        entry = _Entry(key, printer)
+        entry.in_use = True
+        with self._lock:
+            self._entries[printer_id] = entry
+            self._start_reaper()
+        return entry, False
+
+    def _checkin(self, printer_id, entry):
+        with self._lock:
+            entry.in_use = False
+            entry.last_used = time.monotonic()
+            if not entry.stale:
+                return
+            if self._entries.get(printer_id) is entry:
+                del self._entries[printer_id]
+        close_quietly(entry.printer)
+
+    def _discard(self, printer_id, entry):
+        with self._lock:
+            if self._entries.get(printer_id) is entry:
+                del self._entries[printer_id]
+        close_quietly(entry.printer)
+
+    def _start_reaper(self):
+        if self._reaper is None and self.idle_timeout:
+            self._reaper = threading.Thread(target=self._reap_idle, name="printer-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_idle(self):
+        while True:
+            time.sleep(max(1, min(self.idle_timeout / 2, 30)))
+            now = time.monotonic()
+            idle = []
+            with self._lock:
+                for printer_id, entry in list(self._entries.items()):
+                    if not entry.in_use and now - entry.last_used > self.idle_timeout:
+                        del self._entries[printer_id]
+                        idle.append((printer_id, entry))
+            for printer_id, entry in idle:
+                log.info("Closing idle connection to printer '%s'", printer_id, extra={"printer_id": printer_id})
+                close_quietly(entry.printer)
@@ -0,0 +1,53 @@
+"""Priority lanes, so bulk printing can't hold up kitchen tickets.
+
+Each print message is put in a lane: its "priority" field ("high",
+"normal" or "low") if it has one, otherwise by its "kind" (or "type"),
+see DEFAULT_KINDS. A printer's local queue then runs jobs in order of
+enqueue time + the lane's slack. A new kitchen ticket goes ahead of a
+reprint batch that is already waiting. A low priority job still prints
+once it has waited its slack, so bulk work slows down under load but
+never starves.
+
+With "max_priority" set, the agent also declares its RabbitMQ queue with
+x-max-priority. The broker then delivers messages published with a
+higher AMQP priority first. RabbitMQ can't add that argument to an
+existing queue, so the queue has to be deleted and declared again once.
+"""
+
+LANES = ("high", "normal", "low")
+
+DEFAULT_KINDS = {
+    "kitchen": "high",
+    "order": "high",
+    "receipt": "high",
+    "report": "low",
+    "reprint": "low",
+}
+DEFAULT_SLACK = {"high": 0, "normal": 5, "low": 60}  # Seconds a job may be overtaken by more urgent ones
+
+
+class PriorityPolicy:
+    def __init__(self, kinds=None, slack=None):
+        self.kinds = dict(DEFAULT_KINDS, **(kinds or {}))
+        self.slack = dict(DEFAULT_SLACK, **(slack or {}))
+
+    def lane(self, message):
+        lane = message.get("priority")
+        if lane in LANES:
+            return lane
+        return self.kinds.get(message.get("kind") or message.get("type"), "normal")
+
+    def deadline(self, lane, enqueued_at):
+        """Sort key for a printer's queue: earlier runs first."""
+        return enqueued_at + self.slack.get(lane, 0)
+
+
+def from_config(config):
+    return PriorityPolicy(config.get("priority_kinds"), config.get("priority_slack_seconds"))
+
+
+def queue_arguments(config):
+    """Arguments for declaring the main queue: x-max-priority, if configured."""
+    if config.get("max_priority"):
+        return {"x-max-priority": int(config["max_priority"])}
+    return None
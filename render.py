@@ -0,0 +1,345 @@
+"""Compiles print messages into raw ESC/POS byte buffers.
+
+A receipt is built as one bytes object and written to the printer in a
+single call. Blocks that repeat from ticket to ticket are encoded once and
+kept in BLOCK_CACHE, an LRU bounded by total size: header/footer text,
+logos rasterized to bitmaps, QR codes and barcodes.
+
+Messages carry plain "lines", formatted "segments", or both:
+
+    {"text": "TOTAL 12.50", "bold": true, "size": "double", "align": "right"}
+    {"qr": "https://example.com/menu", "size": 6, "align": "center"}
+    {"barcode": "000123", "type": "CODE128", "height": 80}
+    {"image": "<base64 PNG/JPEG>"} or {"image_url": "https://..."}
+    {"feed": 2}
+
+Decoding and dithering images runs in a process pool, so big logos never
+hold the GIL the consumer and printer workers need. The resulting rasters
+are memoized by content hash.
+"""
+
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import threading
+
+ESC = b"\x1b"
+GS = b"\x1d"
+
+INIT = ESC + b"@"
+FEED_AND_CUT = ESC + b"d\x06" + GS + b"V\x00"
+
+# ESC t code page numbers for the encodings we can produce
+CODEPAGES = {
+    "cp437": 0,
+    "cp850": 2,
+    "cp860": 3,
+    "cp863": 4,
+    "cp865": 5,
+    "cp1252": 16,
+    "cp866": 17,
+    "cp852": 18,
+    "cp858": 19,
+}
+DEFAULT_ENCODING = "cp850"
+
+ALIGNMENTS = {"left": 0, "center": 1, "right": 2}
+TEXT_SIZES = {"normal": (1, 1), "wide": (2, 1), "tall": (1, 2), "double": (2, 2)}
+RESET_FORMAT = ESC + b"a\x00" + ESC + b"E\x00" + ESC + b"-\x00" + GS + b"!\x00"
+
+QR_ERROR_LEVELS = {"L": 48, "M": 49, "Q": 50, "H": 51}
+BARCODE_TYPES = {
+    "UPC-A": 65,
+    "UPC-E": 66,
+    "EAN13": 67,
+    "EAN8": 68,
+    "CODE39": 69,
+    "ITF": 70,
+    "CODABAR": 71,
+    "CODE93": 72,
+    "CODE128": 73,
+}
+RASTER_BAND_HEIGHT = 256
+_INVERT = bytes(255 - i for i in range(256))
+
+
+class ByteLRU:
+    """Thread-safe LRU cache of bytes values, bounded by their total size."""
+
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_or_build(self, key, build):
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value)
+        return value
+
+
+BLOCK_CACHE = ByteLRU()
+
+IMAGE_WORKERS = 1
+IMAGE_FETCH_TIMEOUT = 10
+_image_pool = None
+_image_futures = {}
+_image_lock = threading.Lock()
+
+
+def configure(cache_bytes=None, image_workers=None):
+    """Apply config.json settings; call once at startup before printing."""
+    global IMAGE_WORKERS
+    if cache_bytes is not None:
+        BLOCK_CACHE.max_bytes = cache_bytes
+    if image_workers is not None:
+        IMAGE_WORKERS = image_workers
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def select_codepage(encoding):
+    return ESC + b"t" + bytes([CODEPAGES.get(encoding, CODEPAGES[DEFAULT_ENCODING])])
+
+
+def encode_text(text, encoding=DEFAULT_ENCODING):
+    if encoding not in CODEPAGES:
+        encoding = DEFAULT_ENCODING
+    return text.encode(encoding, errors="replace")
+
+
+def text_block(lines, encoding=DEFAULT_ENCODING):
+    return encode_text("".join(f"{line}\n" for line in lines), encoding)
+
+
+def static_text_block(lines, encoding=DEFAULT_ENCODING):
+    """A text block that repeats across tickets, such as a store header."""
+    lines = tuple(lines)
+    return BLOCK_CACHE.get_or_build(("text", encoding, lines), lambda: text_block(lines, encoding))
+
+
+def raster_image(image, max_width=576):
+    """GS v 0 raster bitmap commands for a PIL image, dithered to 1 bit."""
+    from PIL import Image
+
+    if image.width > max_width:
+        height = max(1, round(image.height * max_width / image.width))
+        image = image.resize((max_width, height))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, "white")
+        image = Image.alpha_composite(background, image)
+    image = image.convert("L")
+    # Pad to a whole number of bytes per row with white, then dither
+    width = (image.width + 7) // 8 * 8
+    if width != image.width:
+        padded = Image.new("L", (width, image.height), 255)
+        padded.paste(image, (0, 0))
+        image = padded
+    bits = image.convert("1").tobytes().translate(_INVERT)  # ESC/POS: 1 = black
+    row_bytes = width // 8
+    parts = []
+    for top in range(0, image.height, RASTER_BAND_HEIGHT):
+        rows = min(RASTER_BAND_HEIGHT, image.height - top)
+        header = GS + b"v0\x00" + row_bytes.to_bytes(2, "little") + rows.to_bytes(2, "little")
+        parts.append(header + bits[top * row_bytes:(top + rows) * row_bytes])
+    return b"".join(parts)
+
+
+def rasterize(data, max_width=576):
+    """Decode encoded image bytes (PNG, JPEG, ...) into raster commands.
+
+    Runs in the image process pool, so it must stay a picklable top-level
+    function.
+    """
+    import io
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        return raster_image(image, max_width)
+
+
+def _run_rasterize(data, max_width):
+    global _image_pool
+    if IMAGE_WORKERS <= 0:
+        return rasterize(data, max_width)
+    with _image_lock:
+        if _image_pool is None:
+            _image_pool = concurrent.futures.ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        pool = _image_pool
+    return pool.submit(rasterize, data, max_width).result()
+
+
+def image_block(data, max_width=576):
+    """Raster commands for encoded image bytes, memoized by content hash.
+
+    Concurrent requests for the same image share one rasterization.
+    """
+    key = ("image", content_hash(data), max_width)
+    value = BLOCK_CACHE.get(key)
+    if value is not None:
+        return value
+    with _image_lock:
+        future = _image_futures.get(key)
+        owner = future is None
+        if owner:
+            future = _image_futures[key] = concurrent.futures.Future()
+    if not owner:
+        return future.result()
+    try:
+        value = _run_rasterize(data, max_width)
+        BLOCK_CACHE.put(key, value)
+        future.set_result(value)
+        return value
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _image_lock:
+            del _image_futures[key]
+
+
+def image_url_block(url, max_width=576):
+    """Raster commands for an image fetched over HTTP, cached by URL."""
+    key = ("image_url", url, max_width)
+    value = BLOCK_CACHE.get(key)
+    if value is None:
+        import requests
+
+        resp = requests.get(url, timeout=IMAGE_FETCH_TIMEOUT)
+        resp.raise_for_status()
+        value = image_block(resp.content, max_width)
+        BLOCK_CACHE.put(key, value)
+    return value
+
+
+def qr_block(data, size=6, error_level="M"):
+    """Printer-native QR code (GS ( k), cached by content."""
+    def build():
+        payload = data.encode("utf-8")
+        store_len = (len(payload) + 3).to_bytes(2, "little")
+        return (
+            GS + b"(k\x04\x00\x31\x41\x32\x00"  # Model 2
+            + GS + b"(k\x03\x00\x31\x43" + bytes([max(1, min(16, int(size)))])
+            + GS + b"(k\x03\x00\x31\x45" + bytes([QR_ERROR_LEVELS.get(error_level, 49)])
+            + GS + b"(k" + store_len + b"\x31\x50\x30" + payload
+            + GS + b"(k\x03\x00\x31\x51\x30"  # Print the stored symbol
+        )
+
+    return BLOCK_CACHE.get_or_build(("qr", data, size, error_level), build)
+
+
+def barcode_block(data, symbology="CODE128", height=80, width=3, show_text=True):
+    """Printer-native barcode (GS k, function B), cached by content."""
+    symbology = symbology.upper()
+    if symbology not in BARCODE_TYPES:
+        raise ValueError(f"Unsupported barcode type: {symbology}")
+
+    def build():
+        payload = data.encode("ascii")
+        if symbology == "CODE128" and not payload.startswith(b"{"):
+            payload = b"{B" + payload  # Code set B
+        return (
+            GS + b"h" + bytes([max(1, min(255, int(height)))])
+            + GS + b"w" + bytes([max(2, min(6, int(width)))])
+            + GS + b"H" + (b"\x02" if show_text else b"\x00")
+            + GS + b"k" + bytes([BARCODE_TYPES[symbology], len(payload)]) + payload
+        )
+
+    return BLOCK_CACHE.get_or_build(("barcode", data, symbology, height, width, show_text), build)
+
+
+def text_format(segment):
+    """ESC/POS commands for a text segment's alignment, emphasis and size."""
+    commands = b""
+    if segment.get("align"):
+        commands += ESC + b"a" + bytes([ALIGNMENTS.get(segment["align"], 0)])
+    if segment.get("bold"):
+        commands += ESC + b"E\x01"
+    if segment.get("underline"):
+        commands += ESC + b"-\x01"
+    size = segment.get("size")
+    if size:
+        if isinstance(size, dict):
+            width, height = size.get("width", 1), size.get("height", 1)
+        else:
+            width, height = TEXT_SIZES.get(size, (1, 1))
+        width, height = max(1, min(8, int(width))), max(1, min(8, int(height)))
+        commands += GS + b"!" + bytes([(width - 1) << 4 | (height - 1)])
+    return commands
+
+
+def segment_block(segment, encoding=DEFAULT_ENCODING):
+    max_width = int(segment.get("max_width", 576))
+    if "text" in segment:
+        body = text_block(str(segment["text"]).split("\n"), encoding)
+    elif "qr" in segment:
+        body = qr_block(str(segment["qr"]), segment.get("size", 6), segment.get("error", "M")) + b"\n"
+    elif "barcode" in segment:
+        body = barcode_block(
+            str(segment["barcode"]),
+            segment.get("type", "CODE128"),
+            segment.get("height", 80),
+            segment.get("width", 3),
+            segment.get("show_text", True),
+        )
+    elif "image" in segment:
+        body = image_block(base64.b64decode(segment["image"]), max_width)
+    elif "image_url" in segment:
+        body = image_url_block(segment["image_url"], max_width)
+    elif "feed" in segment:
+        return ESC + b"d" + bytes([max(0, min(255, int(segment["feed"])))])
+    else:
+        raise ValueError(f"Unknown segment: {sorted(segment)}")
+    if "text" not in segment:
+        segment = {"align": segment.get("align")}  # Only alignment applies to graphics
+    commands = text_format(segment)
+    if not commands:
+        return body
+    return commands + body + RESET_FORMAT
+
+
+def compile_message(message, encoding=DEFAULT_ENCODING):
+    """Build the complete ESC/POS buffer for a print message, ending in a cut."""
+    parts = [INIT, select_codepage(encoding)]
+    if message.get("header"):
+        parts.append(static_text_block(message["header"], encoding))
+    if message.get("lines"):
+        parts.append(text_block(message["lines"], encoding))
+    for segment in message.get("segments", []):
+        parts.append(segment_block(segment, encoding))
+    if message.get("footer"):
+        parts.append(static_text_block(message["footer"], encoding))
+    parts.append(FEED_AND_CUT)
+    return b"".join(parts)
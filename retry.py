@@ -0,0 +1,116 @@
+import copy
+import logging
+
+from metrics import REDELIVERIES
+
+log = logging.getLogger(__name__)
+
+ATTEMPTS_HEADER = "x-print-attempts"
+ERROR_HEADER = "x-print-error"
+
+
+class RetryPolicy:
+    """Delayed retries and dead-lettering for failed print jobs.
+
+    A failed delivery is acked and a copy is republished to a delay queue
+    named <queue>.retry.<delay_ms>. That queue has a TTL and dead-letters the
+    copy back to the main queue when it expires. The delay doubles with each
+    attempt, and the count is kept in the x-print-attempts header. After
+    max_attempts, or straight away for messages that can never succeed, the
+    copy goes to <queue>.dead instead and is never consumed again.
+
+    Jobs for a printer that is known to be down are held instead: parked in
+    the hold_ms delay queue without counting an attempt. Jobs for a printer
+    whose local queue is full ("busy") wait base_delay_ms, also without
+    counting an attempt.
+    """
+
+    def __init__(self, queue_name, max_attempts=5, base_delay_ms=2000, max_delay_ms=60000, hold_ms=5000):
+        self.queue_name = queue_name
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay_ms = int(base_delay_ms)
+        self.max_delay_ms = int(max_delay_ms)
+        self.hold_ms = int(hold_ms)
+
+    @property
+    def dead_letter_queue(self):
+        return f"{self.queue_name}.dead"
+
+    def delay_ms(self, attempt):
+        return min(self.base_delay_ms * 2 ** (attempt - 1), self.max_delay_ms)
+
+    def delay_queue(self, delay_ms):
+        return f"{self.queue_name}.retry.{delay_ms}"
+
+    def delay_queue_arguments(self, delay_ms):
+        return {
+            "x-message-ttl": delay_ms,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": self.queue_name,
+        }
+
+    def queues(self):
+        """(name, arguments) of every queue the policy publishes to."""
+        yield self.dead_letter_queue, None
+        delays = {self.delay_ms(a) for a in range(1, self.max_attempts)} | {self.hold_ms, self.base_delay_ms}
+        for delay_ms in sorted(delays):
+            yield self.delay_queue(delay_ms), self.delay_queue_arguments(delay_ms)
+
+    def declare(self, channel):
+        for name, arguments in self.queues():
+            channel.queue_declare(queue=name, durable=True, arguments=arguments)
+
+    def route(self, headers, reason, poison=False, hold=False, busy=False):
+        """Return (queue_name, headers) for the next copy of a failed message."""
+        headers = dict(headers or {})
+        if hold or busy:
+            headers[ERROR_HEADER] = str(reason)[:255]
+            REDELIVERIES.inc(outcome="hold" if hold else "busy")
+            return self.delay_queue(self.hold_ms if hold else self.base_delay_ms), headers
+        attempts = int(headers.get(ATTEMPTS_HEADER, 0)) + 1
+        headers[ATTEMPTS_HEADER] = attempts
+        headers[ERROR_HEADER] = str(reason)[:255]
+        if poison or attempts >= self.max_attempts:
+            REDELIVERIES.inc(outcome="dead_letter")
+            return self.dead_letter_queue, headers
+        REDELIVERIES.inc(outcome="retry")
+        return self.delay_queue(self.delay_ms(attempts)), headers
+
+    def reject(self, acker, delivery_tag, properties, body, reason, poison=False, hold=False, busy=False):
+        """Move a failed delivery to its delay or dead-letter queue.
+
+        Must run on the connection thread. If the copy can't be published,
+        the delivery is nacked and requeued instead so nothing is lost.
+        """
+        channel = acker.channel
+        if not channel.is_open:
+            return
+        queue_name, headers = self.route(getattr(properties, "headers", None), reason, poison, hold, busy)
+        new_properties = copy.copy(properties)
+        new_properties.headers = headers
+        new_properties.delivery_mode = 2
+        try:
+            channel.basic_publish(exchange="", routing_key=queue_name, body=body, properties=new_properties)
+        except Exception as e:
+            log.error("Failed to publish to %s: %s. Requeueing instead", queue_name, e)
+            acker.nack(delivery_tag, requeue=True)
+            return
+        if queue_name == self.dead_letter_queue:
+            log.warning(
+                "Dead-lettered message after %d attempt(s): %s",
+                headers[ATTEMPTS_HEADER],
+                reason,
+                extra={"delivery_tag": delivery_tag, "attempts": headers[ATTEMPTS_HEADER]},
+            )
+        elif hold:
+            log.info("Holding message for %d ms: %s", self.hold_ms, reason, extra={"delivery_tag": delivery_tag})
+        elif busy:
+            log.info("Retrying message in %d ms: %s", self.base_delay_ms, reason, extra={"delivery_tag": delivery_tag})
+        else:
+            log.info(
+                "Retrying message in %d ms: %s",
+                self.delay_ms(headers[ATTEMPTS_HEADER]),
+                reason,
+                extra={"delivery_tag": delivery_tag, "attempts": headers[ATTEMPTS_HEADER]},
+            )
+        acker.ack(delivery_tag)
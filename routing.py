@@ -0,0 +1,89 @@
+"""Printer-affinity routing for several agents sharing one broker.
+
+With "routing_exchange" set, each agent consumes its own durable queue
+(<queue_name>.<agent_id> unless "routing_queue" is given). It binds that
+queue to the exchange with one routing key per printer in its printer map:
+
+    printer.<printer_id>   jobs for one printer
+    agent.<agent_id>       anything meant for this agent as a whole
+    printers               broadcasts, e.g. printer config changes
+
+Publishers send print jobs to the exchange with routing key
+printer.<printer_id>. The broker then delivers each job only to the agent
+that can reach the printer, instead of agents nacking each other's jobs on
+a shared queue. Bindings follow the printer map: printers added on reload
+are bound and removed ones unbound.
+
+Bindings made by an earlier run for printers that were removed while the
+agent was down stay on the durable queue. Their jobs fail as unknown
+printers and end up in the dead-letter queue.
+"""
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PrinterRouting:
+    def __init__(self, exchange, queue_name, agent_id, exchange_type="direct", key_prefix="printer.",
+                 broadcast_key="printers"):
+        self.exchange = exchange
+        self.queue_name = queue_name
+        self.agent_id = agent_id
+        self.exchange_type = exchange_type
+        self.key_prefix = key_prefix
+        self.broadcast_key = broadcast_key
+        self.bound = set()
+
+    def routing_key(self, printer_id):
+        return f"{self.key_prefix}{printer_id}"
+
+    def keys(self, printers):
+        keys = {self.routing_key(printer_id) for printer_id in printers}
+        keys.add(f"agent.{self.agent_id}")
+        if self.broadcast_key:
+            keys.add(self.broadcast_key)
+        return keys
+
+    def changes(self, printers):
+        """(keys to bind, keys to unbind) to match the printer map."""
+        keys = self.keys(printers)
+        return keys - self.bound, self.bound - keys
+
+    def declare(self, channel, printers, arguments=None):
+        """Declare the exchange and this agent's queue and bind every key; call on (re)connect."""
+        channel.exchange_declare(exchange=self.exchange, exchange_type=self.exchange_type, durable=True)
+        channel.queue_declare(queue=self.queue_name, durable=True, arguments=arguments)
+        self.bound = set()
+        self.update(channel, printers)
+
+    def update(self, channel, printers):
+        """Bind new printers and unbind removed ones. Runs on the connection thread."""
+        if not channel.is_open:
+            return  # declare() rebinds everything on reconnect
+        bind, unbind = self.changes(printers)
+        for key in sorted(bind):
+            channel.queue_bind(queue=self.queue_name, exchange=self.exchange, routing_key=key)
+            self.bound.add(key)
+        for key in sorted(unbind):
+            channel.queue_unbind(queue=self.queue_name, exchange=self.exchange, routing_key=key)
+            self.bound.discard(key)
+        if bind or unbind:
+            log.info("Routing %s: bound %s, unbound %s", self.queue_name, sorted(bind), sorted(unbind))
+
+
+def from_config(config, queue_name):
+    """A PrinterRouting for config.json's routing_* keys, or None when routing is off."""
+    if not config.get("routing_exchange"):
+        return None
+    import socket
+
+    agent_id = config.get("agent_id") or socket.gethostname()
+    return PrinterRouting(
+        config["routing_exchange"],
+        config.get("routing_queue") or f"{queue_name}.{agent_id}",
+        agent_id,
+        exchange_type=config.get("routing_exchange_type", "direct"),
+        key_prefix=config.get("routing_key_prefix", "printer."),
+        broadcast_key=config.get("routing_broadcast_key", "printers"),
+    )
@@ -0,0 +1,47 @@
+"""The last printer map and broker settings the backend API returned.
+
+The agent saves them after every successful fetch and starts from them at
+boot, so a store keeps printing while the backend is slow or down. The
+file holds the RabbitMQ URL and its password. It is written atomically,
+readable only by the agent's user (0600).
+"""
+
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+def load(path):
+    """{"printers", "rabbitmq_url", "queue_name", "saved_at"}, or None if there is no usable snapshot."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning("Ignoring unreadable snapshot %s: %s", path, e)
+        return None
+    if not (isinstance(data, dict) and isinstance(data.get("printers"), dict)
+            and data.get("rabbitmq_url") and data.get("queue_name")):
+        log.warning("Ignoring incomplete snapshot %s", path)
+        return None
+    return data
+
+
+def save(path, printers, rabbitmq_url, queue_name):
+    data = {"saved_at": time.time(), "rabbitmq_url": rabbitmq_url, "queue_name": queue_name, "printers": printers}
+    tmp_path = f"{path}.tmp"
+    try:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)  # os.open's mode only applies to new files
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning("Could not save snapshot %s: %s", path, e)
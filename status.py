@@ -0,0 +1,240 @@
+"""Real-time printer status (DLE EOT) over two-way printer links.
+
+A pooled connection to a network, USB, serial or RFCOMM printer can be
+read as well as written. StatusMonitor uses this in three ways:
+
+- It polls connections no job is using in the background, and caches
+  the result per printer. A poll holds the connection like a job does,
+  so a job waits at most a poll's timeout and never shares the device.
+- Jobs for a printer whose cached status says cover open, out of paper,
+  error or offline are held without touching the device. A printer with
+  a problem is polled (and reconnected if needed) until it clears.
+- For printers that have answered before, a job's write ends with the
+  status queries. DLE EOT is answered as soon as the printer has
+  received everything before it, so the reply confirms that the printer
+  took the ticket, without a separate round trip. A problem in that
+  reply holds the jobs after it; the ticket itself is in the printer's
+  buffer and prints once the problem is fixed, so it is not sent again.
+  No reply at all means the ticket may be lost (e.g. a half-open socket
+  to a printer that restarted): the job fails, the connection is dropped
+  and the printer's jobs are held until a poll gets an answer again.
+
+Printers that never answer are left alone after a few polls.
+"""
+
+import concurrent.futures
+import functools
+import logging
+import select
+import socket
+import threading
+import time
+
+from printer_pool import connection_key
+
+log = logging.getLogger(__name__)
+
+DLE_EOT = b"\x10\x04"
+QUERY = DLE_EOT + b"\x01" + DLE_EOT + b"\x02" + DLE_EOT + b"\x04"  # printer, offline cause, paper sensor
+REPLY_SIZE = 3
+SILENT_POLLS = 3  # Polls without a reply before a printer counts as not answering status queries
+
+
+class PrinterStatus:
+    def __init__(self, online=True, cover_open=False, paper_out=False, paper_low=False, error=False, replied=True):
+        self.replied = replied  # False for a printer that stopped answering
+        self.online = online
+        self.cover_open = cover_open
+        self.paper_out = paper_out
+        self.paper_low = paper_low
+        self.error = error
+        self.checked_at = time.monotonic()
+
+    @property
+    def problem(self):
+        """What keeps the printer from printing, or None."""
+        if not self.replied:
+            return "no status reply"
+        if self.cover_open:
+            return "cover open"
+        if self.paper_out:
+            return "out of paper"
+        if self.error:
+            return "printer error"
+        if not self.online:
+            return "offline"
+        return None
+
+
+def parse(reply):
+    """A PrinterStatus from the three status bytes, or None if they aren't a status reply."""
+    if len(reply) < REPLY_SIZE or any(b & 0x93 != 0x12 for b in reply[:REPLY_SIZE]):
+        return None  # Every status byte has bits 1 and 4 set and bits 0 and 7 clear
+    printer, offline, paper = reply[:REPLY_SIZE]
+    return PrinterStatus(
+        online=not printer & 0x08,
+        cover_open=bool(offline & 0x04),
+        paper_out=bool(offline & 0x20) or paper & 0x60 == 0x60,
+        paper_low=paper & 0x0C == 0x0C,
+        error=bool(offline & 0x40),
+    )
+
+
+def drain(printer):
+    """Drop unread bytes, e.g. the late reply to a query that timed out."""
+    device = printer.device
+    if isinstance(device, socket.socket):
+        while select.select([device], [], [], 0)[0]:
+            if not device.recv(64):
+                return
+    elif hasattr(device, "reset_input_buffer"):  # pyserial
+        device.reset_input_buffer()
+
+
+def read_reply(printer, timeout):
+    reply = b""
+    deadline = time.monotonic() + timeout
+    device = printer.device
+    while len(reply) < REPLY_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if isinstance(device, socket.socket):
+            if not select.select([device], [], [], remaining)[0]:
+                break
+            chunk = device.recv(REPLY_SIZE - len(reply))
+            if not chunk:
+                break
+        else:
+            try:
+                chunk = printer._read()  # Serial and USB reads time out on their own
+            except NotImplementedError:
+                break
+            except Exception as e:
+                log.debug("Status read failed: %s", e)
+                break
+        reply += bytes(chunk)
+    return reply
+
+
+def query(printer, data=b"", timeout=2):
+    """Write data followed by the status queries; the printer's status, or None if it didn't answer."""
+    drain(printer)
+    printer._raw(data + QUERY)
+    return parse(read_reply(printer, timeout))
+
+
+class StatusMonitor:
+    """Cached status per printer, kept fresh by polling idle pooled connections.
+
+    is_pooled(printer_cfg) says whether the printer's backend keeps a
+    connection in pool; opener opens one.
+    """
+
+    def __init__(self, pool, get_printers, opener, is_pooled, interval=5, poll_timeout=0.5, confirm_timeout=5,
+                 workers=8):
+        self.pool = pool
+        self.get_printers = get_printers
+        self.opener = opener
+        self.is_pooled = is_pooled
+        self.interval = interval
+        self.poll_timeout = poll_timeout
+        self.confirm_timeout = confirm_timeout
+        self.workers = workers
+        self._status = {}  # printer_id -> PrinterStatus
+        self._answering = set()  # connection keys that have answered a status query
+        self._silent = {}  # connection key -> polls without a reply
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval:
+            self._thread = threading.Thread(target=self._run, name="printer-status", daemon=True)
+            self._thread.start()
+
+    def problem(self, printer_id):
+        with self._lock:
+            status = self._status.get(printer_id)
+        return status.problem if status is not None else None
+
+    def ready_states(self):
+        """{printer_id: 1 if ready, 0 if it reports a problem}, for the pos_agent_printer_ready gauge."""
+        with self._lock:
+            return {printer_id: int(status.problem is None) for printer_id, status in self._status.items()}
+
+    def answers(self, printer_cfg):
+        with self._lock:
+            return connection_key(printer_cfg) in self._answering
+
+    def confirm(self, printer_id, printer_cfg, printer, data):
+        """Write a job and read the status after it; runs on the printer's worker inside the pool."""
+        status = query(printer, data, self.confirm_timeout)
+        if status is None:
+            log.warning("Printer '%s' did not confirm the job within %.1f s", printer_id, self.confirm_timeout,
+                        extra={"printer_id": printer_id})
+            self._record(printer_id, printer_cfg, PrinterStatus(replied=False))  # Holds its jobs until it answers
+        else:
+            self._record(printer_id, printer_cfg, status)
+        return status
+
+    def poll_all(self):
+        printers = self.get_printers() or {}
+        with self._lock:
+            for printer_id in set(self._status) - set(printers):
+                del self._status[printer_id]
+        targets = [(printer_id, cfg) for printer_id, cfg in printers.items() if self.is_pooled(cfg)]
+        if not targets:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(targets))) as pool:
+            list(pool.map(lambda item: self.poll(*item), targets))
+
+    def poll(self, printer_id, printer_cfg):
+        key = connection_key(printer_cfg)
+        with self._lock:
+            if key not in self._answering and self._silent.get(key, 0) >= SILENT_POLLS:
+                return
+        action = functools.partial(query, timeout=self.poll_timeout)
+        try:
+            # Keep asking a printer with a problem, reconnecting if needed, until it's fixed
+            opener = self.opener if self.problem(printer_id) else None
+            ran, status = self.pool.run_if_idle(printer_id, printer_cfg, action, opener)
+            if not ran:
+                return  # A job is using the connection and reports on the printer itself
+        except Exception as e:
+            log.debug("Status poll of printer '%s' failed: %s", printer_id, e, extra={"printer_id": printer_id})
+            return  # The health monitor deals with printers that can't be reached
+        if status is not None:
+            self._record(printer_id, printer_cfg, status)
+            return
+        with self._lock:
+            silent = self._silent[key] = self._silent.get(key, 0) + 1
+            answering = key in self._answering
+        if answering:
+            self.pool.invalidate(printer_id)  # Maybe half-open; the next job or poll reconnects
+        if silent == SILENT_POLLS and not answering:
+            log.info("Printer '%s' does not answer status queries; not polling it", printer_id,
+                     extra={"printer_id": printer_id})
+
+    def _record(self, printer_id, printer_cfg, status):
+        key = connection_key(printer_cfg)
+        with self._lock:
+            self._answering.add(key)
+            self._silent.pop(key, None)
+            old = self._status.get(printer_id)
+            self._status[printer_id] = status
+        was, now = old.problem if old is not None else None, status.problem
+        if now and now != was:
+            log.warning("Printer '%s' reports %s -- Holding its jobs", printer_id, now,
+                        extra={"printer_id": printer_id})
+        elif was and not now:
+            log.info("Printer '%s' is ready again", printer_id, extra={"printer_id": printer_id})
+        if status.paper_low and not (old is not None and old.paper_low):
+            log.warning("Printer '%s' is running out of paper", printer_id, extra={"printer_id": printer_id})
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll_all()
+            except Exception as e:
+                log.exception("Printer status poll failed: %s", e)
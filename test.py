@@ -1,54 +1,22 @@
 import asyncio
-from bleak import BleakClient, BleakScanner
+import sys
 
-# Replace this with your printer's MAC address
-PRINTER_MAC = "66:32:30:73:CA:C8"
+from backends.ble import AsyncBlePrinter
+from render import compile_message
 
-# Example ESC/POS commands
-def escpos_text(text):
-    # Convert string to bytes with line feed
-    return text.encode('utf-8') + b'\n'
-
-def escpos_cut():
-    # ESC/POS cut command
-    return b'\x1dV\x01'
+# Replace this with your printer's MAC address, or pass it as an argument
+PRINTER_MAC = sys.argv[1] if len(sys.argv) > 1 else "66:32:30:73:CA:C8"
 
 async def print_to_ble():
-    # Scan for devices to make sure printer is available
-    devices = await BleakScanner.discover()
-    printer = None
-    for d in devices:
-        if d.address.upper() == PRINTER_MAC:
-            printer = d
-            break
-    if not printer:
-        print("Printer not found!")
-        return
-
-    async with BleakClient(PRINTER_MAC) as client:
-        print(f"Connected to {PRINTER_MAC}")
-
-        # Find writable characteristic (usually contains "write" or "tx")
-        services = await client.get_services()
-        write_char = None
-        for service in services:
-            for char in service.characteristics:
-                if "write" in char.properties:
-                    write_char = char
-                    break
-            if write_char:
-                break
-
-        if not write_char:
-            print("No writable characteristic found!")
-            return
-
-        # Send text
-        await client.write_gatt_char(write_char.uuid, escpos_text("Hello from Raspberry Pi BLE!"))
-        await client.write_gatt_char(write_char.uuid, escpos_text("Printing ESC/POS via BLE"))
-        await client.write_gatt_char(write_char.uuid, escpos_cut())
-
+    # Same code path as the agent's bluetooth-le printers: one connection,
+    # one cached write characteristic, MTU-sized chunks
+    printer = AsyncBlePrinter(PRINTER_MAC)
+    data = compile_message({"lines": ["Hello from Raspberry Pi BLE!", "Printing ESC/POS via BLE"]})
+    try:
+        await printer.write(data)
         print("Print job sent!")
+    finally:
+        await printer.close()
 
 # Run the async function
 asyncio.run(print_to_ble())